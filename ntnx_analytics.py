@@ -0,0 +1,246 @@
+############################################################
+#
+#  Script: Analyze Nutanix Cluster capacity and allocation
+#  Author: Yukiya Shimizu
+#  Description: Overcommit, free capacity, percentiles and top consumers across clusters
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import json
+import numpy as np
+from ntnx_multi_cluster import CLUSTER_TAG
+
+# Collections the analytics are computed from
+ANALYTICS_QUERIES = ["cluster", "hosts", "storage_containers", "vms"]
+# v2 leaves the disks out of the VMs unless asked for
+ANALYTICS_PARAMS = {"vms": {"include_vm_disk_config": "true"}}
+PERCENTILES = [50, 90, 99]
+TOP_N = 10
+
+
+def get_stat(entity, key):
+    # Usage stats are strings in v2, missing ones count as 0
+    return int((entity.get("usage_stats") or {}).get(key) or 0)
+
+
+def lookup(keys, values):
+    # Row of each value in keys, -1 where it is not found
+    if not len(keys):
+        return np.full(len(values), -1, dtype=np.int64)
+    order = np.argsort(keys)
+    positions = np.searchsorted(keys, values, sorter=order).clip(0, len(keys) - 1)
+    rows = order[positions]
+    return np.where(keys[rows] == values, rows, -1)
+
+
+def group_percentiles(values, groups, num_groups, percentiles=PERCENTILES):
+    # Percentiles (linear interpolation) of the values of every group in one sorted pass,
+    # as a (num_groups, len(percentiles)) array with NaN for empty groups
+    if not len(values):
+        return np.full((num_groups, len(percentiles)), np.nan)
+
+    order = np.lexsort((values, groups))
+    sorted_values = values[order].astype(np.float64)
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    positions = starts[:, None] + (counts[:, None] - 1) * (np.asarray(percentiles) / 100.0)[None, :]
+    positions = positions.clip(0, len(values) - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    result = sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (positions - lower)
+    result[counts == 0] = np.nan
+    return result
+
+
+def group_top_n(values, groups, num_groups, n=TOP_N):
+    # Rows of the n largest values of every group, as a list of row arrays per group
+    order = np.lexsort((-values, groups))
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    ranks = np.arange(len(order)) - starts[groups[order]]
+    top_rows = order[ranks < n]
+    return np.split(top_rows, np.cumsum(np.minimum(counts, n))[:-1])
+
+
+class NtnxCapacityAnalytics:
+    def __init__(self, results):
+        # Load the merged results of NtnxClusterGroup.query() into one array per field.
+        # Entities are tagged with their cluster, every row refers to its cluster by index.
+        clusters = results.get("cluster", [])
+        hosts = results.get("hosts", [])
+        containers = results.get("storage_containers", [])
+        vms = results.get("vms", [])
+
+        self.cluster_names = np.array(sorted(set(entity[CLUSTER_TAG] for kind in results.values()
+                                                 for entity in kind)), dtype=object)
+        self.num_clusters = len(self.cluster_names)
+        cluster_rows = {cluster: row for row, cluster in enumerate(self.cluster_names)}
+
+        self.cluster_num_nodes = np.zeros(self.num_clusters, dtype=np.int64)
+        for cluster in clusters:
+            self.cluster_num_nodes[cluster_rows[cluster[CLUSTER_TAG]]] = cluster.get("num_nodes") or 0
+
+        self.host_cluster = np.fromiter((cluster_rows[host[CLUSTER_TAG]] for host in hosts), np.int64, len(hosts))
+        self.host_cores = np.fromiter((host.get("num_cpu_cores") or 0 for host in hosts), np.int64, len(hosts))
+        self.host_memory_mb = np.fromiter(((host.get("memory_capacity_in_bytes") or 0) // 2 ** 20
+                                           for host in hosts), np.int64, len(hosts))
+
+        self.container_names = np.array([container.get("name") for container in containers], dtype=object)
+        self.container_uuids = np.array([container.get("storage_container_uuid") or "" for container in containers],
+                                        dtype=object)
+        self.container_cluster = np.fromiter((cluster_rows[container[CLUSTER_TAG]] for container in containers),
+                                             np.int64, len(containers))
+        self.container_capacity = np.fromiter((container.get("max_capacity") or 0 for container in containers),
+                                              np.int64, len(containers))
+        self.container_used = np.fromiter((get_stat(container, "storage.usage_bytes") for container in containers),
+                                          np.int64, len(containers))
+
+        self.vm_names = np.array([vm.get("name") for vm in vms], dtype=object)
+        self.vm_cluster = np.fromiter((cluster_rows[vm[CLUSTER_TAG]] for vm in vms), np.int64, len(vms))
+        self.vm_vcpus = np.fromiter(((vm.get("num_vcpus") or 0) * (vm.get("num_cores_per_vcpu") or 1)
+                                     for vm in vms), np.int64, len(vms))
+        self.vm_memory_mb = np.fromiter((vm.get("memory_mb") or 0 for vm in vms), np.int64, len(vms))
+        self.vm_powered_on = np.fromiter((vm.get("power_state") == "on" for vm in vms), np.bool_, len(vms))
+
+        # One row per virtual disk, CD-ROMs left out
+        disk_vms = []
+        disk_container_uuids = []
+        disk_bytes = []
+        for row, vm in enumerate(vms):
+            for disk in vm.get("vm_disk_info") or []:
+                if disk.get("is_cdrom"):
+                    continue
+                disk_vms.append(row)
+                disk_container_uuids.append(disk.get("storage_container_uuid") or "")
+                disk_bytes.append(disk.get("size") or 0)
+        self.disk_vm = np.array(disk_vms, dtype=np.int64)
+        self.disk_container = lookup(self.container_uuids, np.array(disk_container_uuids, dtype=object))
+        self.disk_bytes = np.array(disk_bytes, dtype=np.int64)
+
+    def cluster_summary(self):
+        # Allocation against the physical capacity of every cluster
+        num_clusters = self.num_clusters
+        num_vms = np.bincount(self.vm_cluster, minlength=num_clusters)
+        cores = np.bincount(self.host_cluster, self.host_cores, num_clusters)
+        memory_mb = np.bincount(self.host_cluster, self.host_memory_mb, num_clusters)
+        vcpus = np.bincount(self.vm_cluster, self.vm_vcpus, num_clusters)
+        vcpus_on = np.bincount(self.vm_cluster, self.vm_vcpus * self.vm_powered_on, num_clusters)
+        allocated_mb = np.bincount(self.vm_cluster, self.vm_memory_mb, num_clusters)
+        allocated_mb_on = np.bincount(self.vm_cluster, self.vm_memory_mb * self.vm_powered_on, num_clusters)
+        capacity = np.bincount(self.container_cluster, self.container_capacity, num_clusters)
+        used = np.bincount(self.container_cluster, self.container_used, num_clusters)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            vcpu_ratio = np.where(cores > 0, vcpus_on / cores, np.nan)
+            memory_ratio = np.where(memory_mb > 0, allocated_mb_on / memory_mb, np.nan)
+
+        vcpu_percentiles = group_percentiles(self.vm_vcpus, self.vm_cluster, num_clusters)
+        memory_percentiles = group_percentiles(self.vm_memory_mb, self.vm_cluster, num_clusters)
+        return [{
+            "cluster": self.cluster_names[row],
+            "num_nodes": int(self.cluster_num_nodes[row]),
+            "num_vms": int(num_vms[row]),
+            "cores": int(cores[row]),
+            "vcpus": int(vcpus[row]),
+            "vcpus_powered_on": int(vcpus_on[row]),
+            "vcpu_overcommit": float(vcpu_ratio[row]),
+            "memory_mb": int(memory_mb[row]),
+            "allocated_memory_mb": int(allocated_mb[row]),
+            "allocated_memory_mb_powered_on": int(allocated_mb_on[row]),
+            "memory_overcommit": float(memory_ratio[row]),
+            "storage_capacity_bytes": int(capacity[row]),
+            "storage_free_bytes": int(capacity[row] - used[row]),
+            "vcpu_percentiles": dict(zip(PERCENTILES, vcpu_percentiles[row].tolist())),
+            "memory_mb_percentiles": dict(zip(PERCENTILES, memory_percentiles[row].tolist())),
+        } for row in range(num_clusters)]
+
+    def container_summary(self):
+        # Used, free and provisioned capacity of every container
+        num_containers = len(self.container_names)
+        on_container = self.disk_container >= 0
+        provisioned = np.bincount(self.disk_container[on_container], self.disk_bytes[on_container], num_containers)
+        free = self.container_capacity - self.container_used
+        with np.errstate(divide="ignore", invalid="ignore"):
+            used_ratio = np.where(self.container_capacity > 0, self.container_used / self.container_capacity, np.nan)
+            provisioned_ratio = np.where(self.container_capacity > 0, provisioned / self.container_capacity, np.nan)
+
+        return [{
+            "cluster": self.cluster_names[self.container_cluster[row]],
+            "name": self.container_names[row],
+            "capacity_bytes": int(self.container_capacity[row]),
+            "used_bytes": int(self.container_used[row]),
+            "free_bytes": int(free[row]),
+            "used_ratio": float(used_ratio[row]),
+            "provisioned_bytes": int(provisioned[row]),
+            "provisioned_ratio": float(provisioned_ratio[row]),
+        } for row in range(num_containers)]
+
+    def top_vms(self, field="memory_mb", n=TOP_N):
+        # The n VMs allocating the most vCPUs or memory in every cluster
+        values = self.vm_vcpus if field == "vcpus" else self.vm_memory_mb
+        return {self.cluster_names[row]: [(self.vm_names[vm_row], int(values[vm_row])) for vm_row in top_rows]
+                for row, top_rows in enumerate(group_top_n(values, self.vm_cluster, self.num_clusters, n))}
+
+    def top_disk_consumers(self, n=TOP_N):
+        # The n VMs provisioning the most disk on every container
+        on_container = self.disk_container >= 0
+        disk_rows = np.flatnonzero(on_container)
+        top = group_top_n(self.disk_bytes[disk_rows], self.disk_container[disk_rows], len(self.container_names), n)
+        return {"{}:{}".format(self.cluster_names[self.container_cluster[row]], self.container_names[row]):
+                [(self.vm_names[self.disk_vm[disk_rows[top_row]]], int(self.disk_bytes[disk_rows[top_row]]))
+                 for top_row in top_rows]
+                for row, top_rows in enumerate(top)}
+
+
+def results_from_store(store):
+    # Results as from NtnxClusterGroup.query() out of the local inventory snapshots.
+    # Snapshots keep the VM model fields only, so disks are not included.
+    results = {}
+    for snapshot in store.get_snapshots():
+        synced_at, entities = store.load_snapshot(snapshot["cluster"], snapshot["kind"])
+        results.setdefault(snapshot["kind"], []).extend(
+            dict(entity, **{CLUSTER_TAG: snapshot["cluster"]}) for entity in entities)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze capacity and allocation of NTNX clusters")
+    parser.add_argument("clusters", nargs="?", help="JSON file of cluster endpoints and credentials")
+    parser.add_argument("--store", help="analyze the local inventory store instead of querying the clusters")
+    parser.add_argument("--top", type=int, default=TOP_N)
+    parser.add_argument("--report", help="write the analytics to this JSON file")
+    args = parser.parse_args()
+
+    if args.store:
+        from ntnx_inventory_store import NtnxInventoryStore
+        inventory_results = results_from_store(NtnxInventoryStore(args.store))
+    else:
+        from ntnx_multi_cluster import NtnxClusterGroup, load_endpoints
+        inventory_results, query_errors = NtnxClusterGroup(load_endpoints(args.clusters)).query(
+            *ANALYTICS_QUERIES, params=ANALYTICS_PARAMS)
+        for cluster_ip, query_name, error in query_errors:
+            print("Failed {} on {}: {}".format(query_name, cluster_ip, error))
+
+    analytics = NtnxCapacityAnalytics(inventory_results)
+    report = {
+        "clusters": analytics.cluster_summary(),
+        "containers": analytics.container_summary(),
+        "top_vms_by_memory_mb": analytics.top_vms("memory_mb", args.top),
+        "top_vms_by_vcpus": analytics.top_vms("vcpus", args.top),
+        "top_disk_consumers": analytics.top_disk_consumers(args.top),
+    }
+
+    print("#" * 79)
+    for cluster_summary in report["clusters"]:
+        print("{cluster}: {num_nodes} nodes, {num_vms} VMs, vCPU {vcpu_overcommit:.2f}x, "
+              "memory {memory_overcommit:.2f}x, {storage_free_bytes} bytes free".format(**cluster_summary))
+    for container_summary in report["containers"]:
+        print("{cluster} {name}: {used_ratio:.1%} used, {free_bytes} bytes free, "
+              "{provisioned_ratio:.1%} provisioned".format(**container_summary))
+
+    if args.report:
+        with open(args.report, "wt") as fout:
+            json.dump(report, fout, indent=2)
@@ -0,0 +1,331 @@
+############################################################
+#
+#  Script: Benchmark Nutanix Cluster handling against a mock Prism Gateway
+#  Author: Yukiya Shimizu
+#  Description: Measure sync, listing and bulk-create workflows locally
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import random
+import resource
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from ntnx_cluster_bak2 import NtnxRestApiSession, NtnxHttpTransport
+from ntnx_vm_batch import NtnxVmBatch
+from ntnx_tasks import NtnxTaskTracker
+
+MOCK_V2_PATH = "/PrismGateway/services/rest/v2.0/"
+MOCK_NUM_VMS = 1000
+MOCK_NUM_CONTAINERS = 8
+MOCK_NUM_NETWORKS = 16
+# Seconds a mock task takes to complete
+MOCK_TASK_DURATION = 0.5
+POWER_STATES = ["on", "off"]
+
+
+class MockInventory:
+    def __init__(self, num_vms=MOCK_NUM_VMS, num_containers=MOCK_NUM_CONTAINERS, num_networks=MOCK_NUM_NETWORKS,
+                 task_duration=MOCK_TASK_DURATION):
+        # Synthetic entities are generated from their index on request, so that
+        # the inventory costs no memory whatever its size
+        self.num_vms = num_vms
+        self.num_containers = num_containers
+        self.num_networks = num_networks
+        self.task_duration = task_duration
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def cluster(self):
+        return {"uuid": "00000000-0000-0000-0000-000000000000", "id": "mock", "name": "mock-cluster",
+                "cluster_external_ipaddress": "127.0.0.1", "num_nodes": 4, "version": "mock",
+                "hypervisor_types": ["kKvm"]}
+
+    def host(self, index):
+        return {"uuid": "host-{}".format(index), "name": "host-{}".format(index), "num_cpu_cores": 32,
+                "memory_capacity_in_bytes": 512 * 2 ** 30}
+
+    def container(self, index):
+        return {"storage_container_uuid": "ctr-{:08d}".format(index), "name": "container-{}".format(index),
+                "max_capacity": 10 * 2 ** 40,
+                "usage_stats": {"storage.usage_bytes": str(index * 2 ** 38),
+                                "storage.user_unreserved_free_bytes": str((10 - index % 10) * 2 ** 38)}}
+
+    def network(self, index):
+        return {"uuid": "net-{:08d}".format(index), "name": "network-{}".format(index), "vlan_id": index,
+                "ip_config": {"network_address": "10.{}.0.0".format(index % 256), "prefix_length": 16,
+                              "default_gateway": "10.{}.0.1".format(index % 256), "pool": []}}
+
+    def vm(self, index, include_vm_disk_config=False):
+        # Disks are only included when asked for, as v2 leaves them out by default
+        vm = {"uuid": "vm-{:08d}".format(index), "name": "vm-{}".format(index),
+              "num_vcpus": 1 + index % 8, "num_cores_per_vcpu": 1, "memory_mb": 1024 * (1 + index % 16),
+              "power_state": POWER_STATES[index % 2], "host_uuid": "host-{}".format(index % 4),
+              "description": "synthetic VM {}".format(index),
+              "vm_nics": [{"network_uuid": "net-{:08d}".format(index % self.num_networks),
+                           "mac_address": "50:6b:8d:{:02x}:{:02x}:{:02x}".format(
+                               index >> 16 & 255, index >> 8 & 255, index & 255)}]}
+        if include_vm_disk_config:
+            vm["vm_disk_info"] = [{"disk_address": {"device_bus": "scsi", "device_index": 0},
+                                   "size": 20 * 2 ** 30,
+                                   "storage_container_uuid": "ctr-{:08d}".format(index % self.num_containers)}]
+        return vm
+
+    @staticmethod
+    def collection(entity, total, first, length):
+        entities = [entity(index) for index in range(first, min(first + length, total))]
+        return {"metadata": {"grand_total_entities": total, "total_entities": total, "count": len(entities)},
+                "entities": entities}
+
+    def get(self, path, query):
+        # Answer a GET as Prism would, paginated by page/count or offset/length
+        if path == "cluster":
+            return 200, self.cluster()
+        elif path == "storage_containers":
+            count = int(query.get("count", [self.num_containers])[0])
+            page = int(query.get("page", [1])[0])
+            return 200, self.collection(self.container, self.num_containers, (page - 1) * count, count)
+        elif path == "hosts":
+            return 200, self.collection(self.host, 4, 0, 4)
+        elif path == "networks":
+            return 200, self.collection(self.network, self.num_networks, 0, self.num_networks)
+        elif path == "vms":
+            offset = int(query.get("offset", [0])[0])
+            length = int(query.get("length", [self.num_vms])[0])
+            include_vm_disk_config = query.get("include_vm_disk_config", ["false"])[0] == "true"
+            return 200, self.collection(lambda index: self.vm(index, include_vm_disk_config), self.num_vms,
+                                        offset, length)
+        elif path.startswith("vms/"):
+            return 200, self.vm(int(path.split("/")[1].split("-")[1]),
+                                query.get("include_vm_disk_config", ["false"])[0] == "true")
+        return 404, {"message": "Unknown endpoint {}".format(path)}
+
+    def create_task(self):
+        task_uuid = str(uuid.uuid4())
+        with self.lock:
+            self.tasks[task_uuid] = time.monotonic() + self.task_duration
+        return task_uuid
+
+    def poll_tasks(self, task_uuids, timeout_interval):
+        # Hold the poll until one of the tasks completes, as tasks/poll does
+        deadline = time.monotonic() + min(timeout_interval, 2)
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                completed = [task_uuid for task_uuid in task_uuids
+                             if task_uuid in self.tasks and self.tasks[task_uuid] <= now]
+                for task_uuid in completed:
+                    del self.tasks[task_uuid]
+            if completed or now >= deadline:
+                break
+            time.sleep(0.05)
+
+        return {"is_timeout": not completed,
+                "completed_tasks_info": [{"uuid": task_uuid, "progress_status": "Succeeded",
+                                          "entity_list": [{"entity_id": "vm-" + task_uuid, "entity_type": "VM"}]}
+                                         for task_uuid in completed]}
+
+    def post(self, path, payload):
+        if path == "vms" or (path.startswith("vms/") and path.endswith(("/clone", "/set_power_state"))):
+            return 201, {"task_uuid": self.create_task()}
+        elif path == "tasks/poll":
+            return 200, self.poll_tasks(payload.get("completed_tasks", []), payload.get("timeout_interval", 10))
+        return 404, {"message": "Unknown endpoint {}".format(path)}
+
+
+class MockPrismHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_request(self, method_type):
+        url = urlsplit(self.path)
+        payload = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        gateway = self.server.gateway
+
+        time.sleep(max(0.0, random.gauss(gateway.latency, gateway.latency / 4)))
+        if random.random() < gateway.error_rate:
+            self.reply(503, {"message": "Service unavailable (injected)"})
+            return
+        if not url.path.startswith(MOCK_V2_PATH):
+            self.reply(404, {"message": "Unknown API {}".format(url.path)})
+            return
+
+        path = url.path[len(MOCK_V2_PATH):].strip("/")
+        if method_type == "get":
+            self.reply(*gateway.inventory.get(path, parse_qs(url.query)))
+        else:
+            self.reply(*gateway.inventory.post(path, json.loads(payload or b"{}")))
+
+    def do_GET(self):
+        self.handle_request("get")
+
+    def do_POST(self):
+        self.handle_request("post")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockPrismGateway:
+    def __init__(self, inventory, latency=0.0, error_rate=0.0):
+        # In-process HTTP stand-in for the v2 API, with latency (seconds) and error rate injection
+        self.inventory = inventory
+        self.latency = latency
+        self.error_rate = error_rate
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), MockPrismHandler)
+        self.server.daemon_threads = True
+        self.server.gateway = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def v2_base_url(self):
+        return "http://{}:" + str(self.server.server_address[1]) + MOCK_V2_PATH
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TimingTransport:
+    def __init__(self, transport):
+        # Records the latency of every request sent through the transport
+        self.transport = transport
+        self.streaming = getattr(transport, "streaming", False)
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def send(self, method_type, request_url, payload_json, timeout, headers=None, stream=False):
+        started_at = time.perf_counter()
+        try:
+            return self.transport.send(method_type, request_url, payload_json, timeout, headers, stream)
+        finally:
+            with self.lock:
+                self.latencies.append(time.perf_counter() - started_at)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Benchmark:
+    def __init__(self, gateway, workers=8):
+        # Only what a workflow needs of the gateway is kept, so that the benchmark can be sent to the
+        # process of a workflow
+        self.v2_base_url = gateway.v2_base_url
+        self.num_containers = gateway.inventory.num_containers
+        self.num_networks = gateway.inventory.num_networks
+        self.workers = workers
+
+    def new_session(self):
+        rest_api = NtnxRestApiSession("127.0.0.1", "admin", "admin", pool_maxsize=self.workers + 1,
+                                      v2_base_url=self.v2_base_url)
+        rest_api.transport = TimingTransport(NtnxHttpTransport(rest_api.session))
+        return rest_api
+
+    def sync_workflow(self, rest_api):
+        rest_api.rest_call("get", "cluster", None)
+        return len(rest_api.get_entities("storage_containers", use_cache=False)) + \
+            len(rest_api.get_entities("networks", use_cache=False))
+
+    def list_workflow(self, rest_api):
+        return sum(1 for vm in rest_api.iter_entities("vms", prefetch=True))
+
+    def bulk_create_workflow(self, rest_api, num_vms):
+        vm_specs = [{"name": "bench-{}".format(index), "num_vcpus": 2, "memory_mb": 2048,
+                     "disks": [{"device_bus": "SCSI", "container": "container-{}".format(index % self.num_containers),
+                                "size": 10240}],
+                     "nics": [{"network": "network-{}".format(index % self.num_networks)}]}
+                    for index in range(num_vms)]
+        tracker = NtnxTaskTracker(rest_api, min_interval=0.05)
+        results = NtnxVmBatch(rest_api, self.workers, tracker).run(vm_specs)
+        return sum(1 for result in results if result["status"] == "SUCCEEDED")
+
+    def run(self, name, workflow, *args):
+        # Run the workflow in a fresh process of its own, so that its peak RSS leaves out
+        # the mock gateway and the workflows run before it
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            return executor.submit(self.measure, name, workflow, *args).result()
+
+    def measure(self, name, workflow, *args):
+        rest_api = self.new_session()
+        started_at = time.perf_counter()
+        # rest_call reports every response code, which is noise here
+        with contextlib.redirect_stdout(io.StringIO()):
+            num_items = workflow(rest_api, *args)
+        elapsed = time.perf_counter() - started_at
+
+        latencies = rest_api.transport.latencies
+        return {
+            "workflow": name,
+            "items": num_items,
+            "requests": len(latencies),
+            "elapsed_s": round(elapsed, 4),
+            "items_per_s": round(num_items / elapsed, 2) if elapsed else None,
+            "requests_per_s": round(len(latencies) / elapsed, 2) if elapsed else None,
+            "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+            "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+            "peak_rss_mb": round(get_peak_rss_mb(), 1),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark against a local mock Prism Gateway")
+    parser.add_argument("--vms", type=int, default=MOCK_NUM_VMS, help="synthetic VMs (10 to 50k)")
+    parser.add_argument("--containers", type=int, default=MOCK_NUM_CONTAINERS)
+    parser.add_argument("--networks", type=int, default=MOCK_NUM_NETWORKS)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean injected latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--create", type=int, default=100, help="VMs created by the bulk-create workflow")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--output", default="bench_output.json", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    mock_inventory = MockInventory(args.vms, args.containers, args.networks)
+    with MockPrismGateway(mock_inventory, args.latency, args.error_rate) as mock_gateway:
+        benchmark = Benchmark(mock_gateway, args.workers)
+        bench_results = [
+            benchmark.run("sync", benchmark.sync_workflow),
+            benchmark.run("list", benchmark.list_workflow),
+            benchmark.run("bulk_create", benchmark.bulk_create_workflow, args.create),
+        ]
+
+    report = {
+        "config": vars(args),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": bench_results,
+    }
+    with open(args.output, "wt") as fout:
+        json.dump(report, fout, indent=2)
+
+    print("#" * 79)
+    for bench_result in bench_results:
+        print("{workflow}: {items} items, {requests} requests in {elapsed_s}s, "
+              "p50 {latency_p50_ms}ms, p99 {latency_p99_ms}ms, peak RSS {peak_rss_mb}MB".format(**bench_result))
@@ -8,72 +8,953 @@
 ############################################################
 
 import pprint
+import asyncio
+import atexit
+import fnmatch
+import glob
+import gzip
 import json
+import os
+import queue
+import random
+import re
+import threading
+import time
 import requests
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlencode, urlsplit
+# Entity models live in their own module, so that this script run as __main__ and the modules
+# it imports share the same model classes
+from ntnx_entities import ENTITY_KEYS, ENTITY_FIELDS, ENTITY_MODELS, NtnxEntityIndex, NtnxChangeSet, \
+    NtnxEntity, NtnxContainer, NtnxNetwork, NtnxVm, make_entity_model, get_fingerprint
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 #V1_BASE_URL = "https://{}:9440/PrismGateway/services/rest/v1/"
 V2_BASE_URL = "https://{}:9440/PrismGateway/services/rest/v2.0/"
+V3_BASE_URL = "https://{}:9440/api/nutanix/v3/"
 POST = "post"
 GET = "get"
+PUT = "put"
 DEBUG = True
-NO_CONN = False
+DEBUG_DIR = "debug"
+# Captures waiting to be written, further ones are dropped instead of blocking REST calls
+DEBUG_QUEUE_SIZE = 64
+DEBUG_COMPRESS = False
+DEBUG_MAX_FILE_BYTES = 16 * 2 ** 20
+DEBUG_BACKUP_COUNT = 5
+# Attribute the wall time of menu operations to network, decode, debug I/O and local processing
+PROFILE = False
+# Upper bounds (seconds) of the REST call latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# "http" talks to the cluster, "record" also captures the responses into the cassette,
+# "replay" serves them from the cassette and "latency" replays them with the recorded timings
+TRANSPORT_MODE = "http"
+CASSETTE_FILE = os.path.join("data", "cassette.jsonl.gz")
 DISK_TYPE = ["SCSI", "IDE", "PCI"]
+# Bytes per unit of the disk sizes entered and given in VM specs, which are in MB
+DISK_SIZE_UNIT = 2 ** 20
+PAGE_SIZE = 500
+# v2 collections which are paginated by offset/length instead of page/count
+OFFSET_PAGINATED = ["vms"]
+# Large v2 collections whose pages are parsed while they arrive when ijson is installed,
+# instead of being revalidated with conditional GETs
+STREAMED_COLLECTIONS = ["vms"]
+CACHE_TTL = 300
+CACHE_MAX_ENTRIES = 64
+# Pages kept with their validators for conditional GETs, e.g. 200 pages for 100k VMs
+VALIDATED_PAGE_TTL = 3600
+VALIDATED_PAGE_MAX_ENTRIES = 256
+# v2 vms filter attribute of each VM filter
+VM_FILTER_ATTRIBUTES = {"power_state": "power_state", "name_pattern": "vm_name", "host_uuid": "host_uuid"}
+VM_LIST_PAGE_SIZE = 20
+# Fields of the v2 VmInfoDTO which can be shown by the VM listing, in addition to the kept ones
+VM_PROJECTION_FIELDS = ENTITY_FIELDS["vms"] + ["description", "timezone", "machine_type", "ha_priority",
+                                               "allow_live_migrate", "vm_logical_timestamp"]
+# Start from the local inventory snapshot, when there is one, and refresh it in the background
+INVENTORY_WARM_START = True
+# HTTP connections kept per session, match it to the number of concurrent workers
+POOL_MAXSIZE = 16
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+MAX_RETRIES = 4
+RETRY_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 30
+# Prism throttling responses, retried for any method as the request was not processed
+THROTTLING_STATUS = [429, 503]
+# Responses of a GET which are retried in addition to throttling ones
+GET_RETRY_STATUS = [500, 502, 504]
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
 pp = pprint.PrettyPrinter(indent=2)
 
 
+class NtnxProfiler:
+    def __init__(self, enabled=PROFILE):
+        # Wall time of each operation split by phase. Phase times are added from any thread
+        # while the operation runs, so overlapping (e.g. prefetched) network time may exceed the wall time.
+        self.enabled = enabled
+        self.current = None
+        self.totals = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        if self.current is None:
+            return
+        with self.lock:
+            if self.current is not None:
+                self.current[phase] = self.current.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def operation(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        self.current = {}
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - started_at
+            with self.lock:
+                phases, self.current = self.current, None
+            phases["local"] = max(0.0, wall - sum(phases.values()))
+            phases["wall"] = wall
+
+            totals = self.totals.setdefault(name, {})
+            for phase, seconds in phases.items():
+                totals[phase] = totals.get(phase, 0.0) + seconds
+            print("Profile of {}: {}".format(name, ", ".join(
+                "{} {:.3f}s".format(phase, seconds) for phase, seconds in phases.items())))
+
+    def report(self):
+        # Total time of each operation by phase
+        return self.totals
+
+
+profiler = NtnxProfiler()
+
+
+class NtnxMetrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        # REST call metrics per (cluster, endpoint): request counts by status, latency histogram,
+        # request/response bytes, retries and decode time
+        self.buckets = buckets
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def get_endpoint(self, cluster, endpoint):
+        key = (cluster, endpoint)
+        metrics = self.endpoints.get(key)
+        if metrics is None:
+            metrics = {
+                "statuses": {},
+                "latency_buckets": [0] * len(self.buckets),
+                "latency_sum": 0.0,
+                "latency_count": 0,
+                "request_bytes": 0,
+                "response_bytes": 0,
+                "retries": 0,
+                "decode_seconds": 0.0,
+                "decode_count": 0,
+            }
+            self.endpoints[key] = metrics
+        return metrics
+
+    def record_request(self, cluster, endpoint, status, latency, request_bytes, response_bytes):
+        with self.lock:
+            metrics = self.get_endpoint(cluster, endpoint)
+            metrics["statuses"][status] = metrics["statuses"].get(status, 0) + 1
+            metrics["latency_sum"] += latency
+            metrics["latency_count"] += 1
+            metrics["request_bytes"] += request_bytes
+            metrics["response_bytes"] += response_bytes
+            for index, upper_bound in enumerate(self.buckets):
+                if latency <= upper_bound:
+                    metrics["latency_buckets"][index] += 1
+                    break
+
+    def record_retry(self, cluster, endpoint):
+        with self.lock:
+            self.get_endpoint(cluster, endpoint)["retries"] += 1
+
+    def record_decode(self, cluster, endpoint, seconds):
+        with self.lock:
+            metrics = self.get_endpoint(cluster, endpoint)
+            metrics["decode_seconds"] += seconds
+            metrics["decode_count"] += 1
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps([dict(metrics, cluster=cluster, endpoint=endpoint,
+                                    statuses={str(status): count for status, count in metrics["statuses"].items()},
+                                    latency_bucket_bounds=self.buckets)
+                               for (cluster, endpoint), metrics in sorted(self.endpoints.items())], indent=2)
+
+    def to_prometheus(self):
+        # Snapshot in the Prometheus text exposition format
+        lines = [
+            "# TYPE ntnx_rest_requests_total counter",
+            "# TYPE ntnx_rest_request_duration_seconds histogram",
+            "# TYPE ntnx_rest_request_bytes_total counter",
+            "# TYPE ntnx_rest_response_bytes_total counter",
+            "# TYPE ntnx_rest_retries_total counter",
+            "# TYPE ntnx_rest_decode_seconds_total counter",
+        ]
+        with self.lock:
+            for (cluster, endpoint), metrics in sorted(self.endpoints.items()):
+                labels = 'cluster="{}",endpoint="{}"'.format(cluster, endpoint)
+                for status, count in sorted(metrics["statuses"].items(), key=str):
+                    lines.append('ntnx_rest_requests_total{{{},status="{}"}} {}'.format(labels, status, count))
+                cumulative = 0
+                for upper_bound, count in zip(self.buckets, metrics["latency_buckets"]):
+                    cumulative += count
+                    lines.append('ntnx_rest_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                        labels, upper_bound, cumulative))
+                lines.append('ntnx_rest_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(
+                    labels, metrics["latency_count"]))
+                lines.append("ntnx_rest_request_duration_seconds_sum{{{}}} {}".format(labels, metrics["latency_sum"]))
+                lines.append("ntnx_rest_request_duration_seconds_count{{{}}} {}".format(
+                    labels, metrics["latency_count"]))
+                lines.append("ntnx_rest_request_bytes_total{{{}}} {}".format(labels, metrics["request_bytes"]))
+                lines.append("ntnx_rest_response_bytes_total{{{}}} {}".format(labels, metrics["response_bytes"]))
+                lines.append("ntnx_rest_retries_total{{{}}} {}".format(labels, metrics["retries"]))
+                lines.append("ntnx_rest_decode_seconds_total{{{}}} {}".format(labels, metrics["decode_seconds"]))
+        return "\n".join(lines) + "\n"
+
+
+def get_endpoint_label(sub_url):
+    # Endpoint of a sub URL without the query, with the entity UUID of e.g. "vms/<uuid>/clone" masked
+    path = sub_url.split("?")[0].strip("/").split("/")
+    if len(path) > 1 and path[0] != "tasks":
+        path[1] = "{uuid}"
+    return "/".join(path)
+
+
+class NtnxDebugWriter:
+    def __init__(self, debug_dir=DEBUG_DIR, queue_size=DEBUG_QUEUE_SIZE, compress=DEBUG_COMPRESS,
+                 max_file_bytes=DEBUG_MAX_FILE_BYTES, backup_count=DEBUG_BACKUP_COUNT):
+        # Writes debug captures on a background thread, one JSON line per capture into
+        # a file per endpoint, rotated into timestamped files when it grows over max_file_bytes
+        self.debug_dir = debug_dir
+        self.compress = compress
+        self.max_file_bytes = max_file_bytes
+        self.backup_count = backup_count
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.num_dropped = 0
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def capture(self, endpoint, data):
+        # Queue the data to be written without blocking. The data is serialized later,
+        # so it must not be modified after being captured.
+        started_at = time.perf_counter()
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop, daemon=True)
+                self.writer.start()
+
+        try:
+            self.queue.put_nowait((endpoint, time.time(), data))
+        except queue.Full:
+            self.num_dropped += 1
+        profiler.add("debug_io", time.perf_counter() - started_at)
+
+    def get_file_name(self, endpoint, suffix=""):
+        extension = ".jsonl.gz" if self.compress else ".jsonl"
+        return os.path.join(self.debug_dir, endpoint.replace("/", "_") + suffix + extension)
+
+    def rotate(self, endpoint, file_name):
+        # Move the current file aside with a timestamp and remove the oldest ones
+        rotated_at = time.time()
+        suffix = ".{}-{:03d}".format(time.strftime("%Y%m%d-%H%M%S", time.localtime(rotated_at)),
+                                     int(rotated_at * 1000) % 1000)
+        os.replace(file_name, self.get_file_name(endpoint, suffix))
+        backups = sorted(glob.glob(self.get_file_name(endpoint, ".*")))
+        for backup in backups[:-self.backup_count]:
+            os.remove(backup)
+
+    def write(self, endpoint, captured_at, data):
+        os.makedirs(self.debug_dir, exist_ok=True)
+        file_name = self.get_file_name(endpoint)
+        if os.path.exists(file_name) and os.path.getsize(file_name) >= self.max_file_bytes:
+            self.rotate(endpoint, file_name)
+
+        line = json.dumps({"captured_at": captured_at, "data": data}, separators=(",", ":"),
+                          default=lambda value: value.to_dict()) + "\n"
+        if self.compress:
+            with gzip.open(file_name, "at", encoding="utf-8") as fout:
+                fout.write(line)
+        else:
+            with open(file_name, "at", encoding="utf-8") as fout:
+                fout.write(line)
+
+    def write_loop(self):
+        while True:
+            endpoint, captured_at, data = self.queue.get()
+            try:
+                self.write(endpoint, captured_at, data)
+            except Exception as ex:
+                print("Writing debug capture of {} failed: {}".format(endpoint, ex))
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout=5):
+        # Wait a while for the queued captures to be written, e.g. at exit, and report the dropped ones
+        deadline = time.monotonic() + timeout
+        while self.writer is not None and self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self.num_dropped:
+            print("{} debug captures were dropped as the queue was full".format(self.num_dropped))
+
+
+debug_writer = NtnxDebugWriter()
+atexit.register(debug_writer.flush)
+
+
+class NtnxEntityCache:
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        # Entities cached per endpoint, evicted when expired or least recently used
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, endpoint):
+        # Return the cached value of the endpoint, or None when missing or expired
+        with self.lock:
+            entry = self.entries.get(endpoint)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[endpoint]
+                return None
+
+            self.entries.move_to_end(endpoint)
+            return value
+
+    def put(self, endpoint, value):
+        with self.lock:
+            self.entries[endpoint] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(endpoint)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, collection=None):
+        # Drop every endpoint of the collection (e.g. "vms", "vms?offset=0", "vms/<uuid>"),
+        # or everything when no collection is given
+        with self.lock:
+            if collection is None:
+                self.entries.clear()
+                return
+
+            for endpoint in list(self.entries.keys()):
+                if endpoint == collection or endpoint.startswith((collection + "?", collection + "/")):
+                    del self.entries[endpoint]
+
+
+class NtnxCircuitOpenError(Exception):
+    pass
+
+
+class NtnxCircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        # Opens after threshold consecutive failures, then lets a single trial call through
+        # every reset_timeout seconds until one succeeds
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+
+            # Half open, the next failure opens it again for another reset_timeout
+            self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class NtnxRateLimiter:
+    def __init__(self, rate, burst=1):
+        # Token bucket letting rate calls per second through, with bursts of up to burst calls
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Wait for a token. A token is reserved ahead, so waiting callers are let through in order.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+def decode_json(content):
+    # Parse a response body straight from its bytes, with orjson when it is installed.
+    # An empty body (e.g. 204) decodes to {} and a non-JSON one (e.g. an HTML error page)
+    # to {"message": <the start of the body>}.
+    if not content or not content.strip():
+        return {}
+
+    try:
+        if orjson:
+            return orjson.loads(content)
+        return json.loads(content)
+    except ValueError:
+        return {"message": content[:1024].decode("utf-8", errors="replace")}
+
+
+def iter_response_entities(server_response, streamed=False):
+    # Yield the entities of a collection response. A streamed response is parsed
+    # incrementally with ijson when it is installed, so entities are yielded as they arrive.
+    # Responses which were not sent with stream=True have been read whole, so their raw is spent.
+    raw = getattr(server_response, "raw", None)
+    if ijson and streamed and raw is not None and hasattr(raw, "read"):
+        raw.decode_content = True
+        for entity in ijson.items(raw, "entities.item", use_float=True):
+            yield entity
+        return
+
+    for entity in decode_json(server_response.content).get("entities") or []:
+        yield entity
+
+
+class NtnxHttpTransport:
+    def __init__(self, session):
+        # Sends requests to the cluster over a requests session
+        self.session = session
+        # GETs with stream=True leave the body on the wire to be read incrementally
+        self.streaming = True
+
+    def send(self, method_type, request_url, payload_json, timeout, headers=None, stream=False):
+        if method_type == GET:
+            return self.session.get(request_url, headers=headers, timeout=timeout, stream=stream)
+        elif method_type == PUT:
+            return self.session.put(request_url, payload_json, headers=headers, timeout=timeout)
+        return self.session.post(request_url, payload_json, headers=headers, timeout=timeout)
+
+
+class NtnxCassetteResponse:
+    def __init__(self, status_code, headers, text, elapsed=0.0):
+        # The parts of a requests.Response a replayed response needs
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.elapsed = elapsed
+
+    def close(self):
+        pass
+
+
+def get_cassette_key(method_type, request_url):
+    # Responses are keyed by method and path, so a cassette can be replayed against any cluster IP
+    url = urlsplit(request_url)
+    return "{} {}{}".format(method_type.upper(), url.path, "?" + url.query if url.query else "")
+
+
+class NtnxRecordTransport:
+    def __init__(self, transport, cassette_file):
+        # Captures every response of the transport into the cassette, a gzipped JSON lines file
+        self.transport = transport
+        self.cassette_file = cassette_file
+        self.lock = threading.Lock()
+        self.streaming = False
+
+    def send(self, method_type, request_url, payload_json, timeout, headers=None, stream=False):
+        # A recorded response is always read whole
+        started_at = time.monotonic()
+        server_response = self.transport.send(method_type, request_url, payload_json, timeout, headers)
+        record = {
+            "key": get_cassette_key(method_type, request_url),
+            "status": server_response.status_code,
+            "headers": dict(server_response.headers),
+            "body": server_response.text,
+            "elapsed": round(time.monotonic() - started_at, 4),
+        }
+
+        # Each record is appended as a gzip member, so the cassette survives an interrupted run
+        with self.lock:
+            with gzip.open(self.cassette_file, "at", encoding="utf-8") as fout:
+                fout.write(json.dumps(record, separators=(",", ":")) + "\n")
+        return server_response
+
+
+class NtnxReplayTransport:
+    def __init__(self, cassette_file):
+        # Serves recorded responses from memory. Responses recorded several times for a key are
+        # replayed in order, repeating the last one.
+        self.records = {}
+        self.replayed = {}
+        self.lock = threading.Lock()
+        self.streaming = False
+        with gzip.open(cassette_file, "rt", encoding="utf-8") as fin:
+            for line in fin:
+                record = json.loads(line)
+                self.records.setdefault(record["key"], []).append(record)
+
+    def get_record(self, method_type, request_url):
+        key = get_cassette_key(method_type, request_url)
+        records = self.records.get(key)
+        if not records:
+            return {"status": 404, "headers": {"Content-Type": "application/json"},
+                    "body": json.dumps({"message": "{} is not recorded in the cassette".format(key)}),
+                    "elapsed": 0.0}
+
+        with self.lock:
+            index = self.replayed.get(key, 0)
+            self.replayed[key] = index + 1
+        return records[min(index, len(records) - 1)]
+
+    def send(self, method_type, request_url, payload_json, timeout, headers=None, stream=False):
+        record = self.get_record(method_type, request_url)
+        return NtnxCassetteResponse(record["status"], record["headers"], record["body"], record["elapsed"])
+
+
+class NtnxLatencyTransport(NtnxReplayTransport):
+    def __init__(self, cassette_file, latency_scale=1.0):
+        # Replays recorded responses after their recorded latency, scaled by latency_scale
+        super().__init__(cassette_file)
+        self.latency_scale = latency_scale
+
+    def send(self, method_type, request_url, payload_json, timeout, headers=None, stream=False):
+        server_response = super().send(method_type, request_url, payload_json, timeout, headers)
+        time.sleep(server_response.elapsed * self.latency_scale)
+        return server_response
+
+
 class NtnxRestApiSession:
-    def __init__(self, ip_address, username, password):
+    def __init__(self, ip_address, username, password, cache_ttl=CACHE_TTL, pool_maxsize=POOL_MAXSIZE,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), max_retries=MAX_RETRIES,
+                 transport_mode=TRANSPORT_MODE, cassette_file=CASSETTE_FILE, v2_base_url=V2_BASE_URL,
+                 metrics=None, v3_base_url=V3_BASE_URL):
         self.cluster_ip_address = ip_address
         self.username = username
         self.password = password
-        self.v2_url = V2_BASE_URL.format(self.cluster_ip_address)
+        self.v2_url = v2_base_url.format(self.cluster_ip_address)
+        # v3 is only used for what v2 does not offer, e.g. time series stats of many entities per call
+        self.v3_url = v3_base_url.format(self.cluster_ip_address)
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.max_retries = max_retries
         self.session = self.get_server_session()
+        self.transport = self.get_transport(transport_mode, cassette_file)
+        self.entity_cache = NtnxEntityCache(cache_ttl)
+        self.circuit_breaker = NtnxCircuitBreaker()
+        # Metrics may be shared by the sessions of many clusters
+        self.metrics = metrics or NtnxMetrics()
+        # Last response of each page with its validators, for conditional GETs
+        self.validated_pages = NtnxEntityCache(VALIDATED_PAGE_TTL, VALIDATED_PAGE_MAX_ENTRIES)
+        # Future of each GET in flight, which identical GETs wait on instead of sending their own
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.num_coalesced = 0
+        # Writes done per collection, part of the key of its GETs in flight so that a GET sent after
+        # a write is never answered with the response of a GET sent before it
+        self.write_counts = {}
+        # Print the response code of every call, turned off e.g. while watching the cluster
+        self.verbose = True
 
     def get_server_session(self):
         # Creating REST client session for server connection, after globally setting.
         # Authorization, content type, and character set for the session.
+        # Connections are pooled so that concurrent workers reuse them instead of handshaking again.
         session = requests.Session()
         session.auth = (self.username, self.password)
         session.verify = False
         session.headers.update(
             {'Content-Type': 'application/json; charset=utf-8'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
         return session
 
-    def rest_call(self, method_type, sub_url, payload_json):
-        if method_type == GET:
-            request_url = self.v2_url + sub_url
-            server_response = self.session.get(request_url)
-        elif method_type == POST:
-            request_url = self.v2_url + sub_url
-            server_response = self.session.post(request_url, payload_json)
+    def get_transport(self, transport_mode, cassette_file):
+        # Creating the transport which the REST calls are sent through
+        if transport_mode == "http":
+            return NtnxHttpTransport(self.session)
+        elif transport_mode == "record":
+            return NtnxRecordTransport(NtnxHttpTransport(self.session), cassette_file)
+        elif transport_mode == "replay":
+            return NtnxReplayTransport(cassette_file)
+        elif transport_mode == "latency":
+            return NtnxLatencyTransport(cassette_file)
+        else:
+            raise ValueError("Transport mode {} is wrong!".format(transport_mode))
+
+    @staticmethod
+    def get_retry_delay(attempt, server_response=None):
+        # Honor Retry-After of a throttling response, or else back off exponentially with full jitter
+        if server_response is not None:
+            retry_after = server_response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(int(retry_after), RETRY_MAX_BACKOFF)
+
+        return random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * (2 ** attempt)))
+
+    def send_request(self, method_type, request_url, payload_json, headers=None, stream=False):
+        # Send a request, retrying GETs on connection errors and any method on throttling
+        if request_url.startswith(self.v3_url):
+            endpoint = "v3/" + get_endpoint_label(request_url[len(self.v3_url):])
         else:
+            endpoint = get_endpoint_label(request_url[len(self.v2_url):])
+        request_bytes = len(payload_json or "")
+        attempt = 0
+        while True:
+            if not self.circuit_breaker.allow():
+                raise NtnxCircuitOpenError("Circuit to the cluster {} is open after repeated failures".format(
+                    self.cluster_ip_address))
+
+            started_at = time.perf_counter()
+            try:
+                server_response = self.transport.send(method_type, request_url, payload_json, self.timeout,
+                                                      headers, stream)
+            except requests.exceptions.RequestException:
+                latency = time.perf_counter() - started_at
+                profiler.add("network", latency)
+                self.metrics.record_request(self.cluster_ip_address, endpoint, "error", latency, request_bytes, 0)
+                self.circuit_breaker.record_failure()
+                if method_type != GET or attempt >= self.max_retries:
+                    raise
+                self.metrics.record_retry(self.cluster_ip_address, endpoint)
+                time.sleep(self.get_retry_delay(attempt))
+                attempt += 1
+                continue
+
+            latency = time.perf_counter() - started_at
+            profiler.add("network", latency)
+            if stream:
+                response_bytes = int(server_response.headers.get("Content-Length") or 0)
+            else:
+                response_bytes = len(server_response.content)
+            self.metrics.record_request(self.cluster_ip_address, endpoint, server_response.status_code, latency,
+                                        request_bytes, response_bytes)
+
+            if server_response.status_code >= 500:
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+
+            retry_status = THROTTLING_STATUS + GET_RETRY_STATUS if method_type == GET else THROTTLING_STATUS
+            if server_response.status_code not in retry_status or attempt >= self.max_retries:
+                return server_response
+
+            # Give the connection of a streamed response back to the pool before retrying
+            server_response.close()
+            if self.verbose:
+                print("Response code: {}, retrying".format(server_response.status_code))
+            self.metrics.record_retry(self.cluster_ip_address, endpoint)
+            time.sleep(self.get_retry_delay(attempt, server_response))
+            attempt += 1
+
+    def rest_request(self, method_type, sub_url, payload_json, headers=None, stream=False, base_url=None):
+        # Send a REST call to the v2 API, or the API at base_url, and return the raw response
+        request_url = (base_url or self.v2_url) + sub_url
+        server_response = self.send_request(method_type, request_url, payload_json, headers, stream)
+        if method_type != GET:
+            # Cached entities of the collection may have been changed by the POST/PUT
+            collection = sub_url.split("/")[0].split("?")[0]
+            self.entity_cache.invalidate(collection)
+            with self.in_flight_lock:
+                self.write_counts[collection] = self.write_counts.get(collection, 0) + 1
+
+        if self.verbose:
+            print("Response code: {}".format(server_response.status_code))
+        return server_response
+
+    def rest_call(self, method_type, sub_url, payload_json, base_url=None):
+        if method_type not in (GET, POST, PUT):
             print("method type is wrong!")
             return
 
-        print("Response code: {}".format(server_response.status_code))
-        return server_response.status_code, json.loads(server_response.text)
+        if method_type == GET:
+            return self.single_flight(self.get_flight_key(sub_url, base_url), self.send_rest_call, method_type,
+                                      sub_url, payload_json, base_url)
+        return self.send_rest_call(method_type, sub_url, payload_json, base_url)
+
+    def send_rest_call(self, method_type, sub_url, payload_json, base_url=None):
+        server_response = self.rest_request(method_type, sub_url, payload_json, base_url=base_url)
+        return server_response.status_code, self.decode_response(sub_url, server_response)
+
+    async def rest_call_async(self, method_type, sub_url, payload_json, base_url=None):
+        # rest_call for asyncio code. The call, or the wait on an identical GET in flight,
+        # runs on the loop's executor so that the event loop is never blocked.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.rest_call, method_type, sub_url, payload_json, base_url)
+
+    def get_flight_key(self, sub_url, base_url=None):
+        # Key of a GET for single_flight, changing with every write to its collection
+        with self.in_flight_lock:
+            num_writes = self.write_counts.get(sub_url.split("/")[0].split("?")[0], 0)
+        return "{} #{}".format((base_url or self.v2_url) + sub_url, num_writes)
+
+    def single_flight(self, key, function, *args):
+        # Call the function once for all the concurrent callers with the same key, which all get its result
+        # (or exception). The result is shared, so callers must not modify it.
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+            else:
+                self.num_coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = function(*args)
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight[key]
+
+    def decode_response(self, sub_url, server_response):
+        # Decode a response body, timing the decode apart from the network
+        started_at = time.perf_counter()
+        response = decode_json(server_response.content)
+        seconds = time.perf_counter() - started_at
+        profiler.add("decode", seconds)
+        self.metrics.record_decode(self.cluster_ip_address, get_endpoint_label(sub_url), seconds)
+        return response
+
+    @staticmethod
+    def get_page_url(sub_url, page_index, page_size=PAGE_SIZE, params=None):
+        # URL of a single page (0-origin) of a v2 collection
+        query = dict(params or {})
+        if sub_url in OFFSET_PAGINATED:
+            query["offset"] = page_index * page_size
+            query["length"] = page_size
+        else:
+            query["page"] = page_index + 1
+            query["count"] = page_size
+        return sub_url + "?" + urlencode(query)
+
+    def get_page(self, sub_url, page_index, page_size=PAGE_SIZE, params=None, conditional=False):
+        # Get a single page (0-origin) of a v2 collection.
+        # A conditional GET revalidates the last response of the page when Prism gave it
+        # an ETag or Last-Modified, so that an unchanged page costs no body on the wire.
+        page_url = self.get_page_url(sub_url, page_index, page_size, params)
+
+        if not conditional:
+            rest_status, response = self.rest_call(GET, page_url, None)
+            if rest_status != 200:
+                raise Exception("HTTP {}: {}".format(rest_status, response.get("message", response)))
+            return response
+        return self.single_flight("conditional " + self.get_flight_key(page_url), self.get_validated_page, page_url)
+
+    def get_validated_page(self, page_url):
+        headers = {}
+        validated_page = self.validated_pages.get(page_url)
+        if validated_page:
+            etag, last_modified, response = validated_page
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        server_response = self.rest_request(GET, page_url, None, headers)
+        if server_response.status_code == 304 and validated_page:
+            return validated_page[2]
+
+        response = self.decode_response(page_url, server_response)
+        if server_response.status_code != 200:
+            raise Exception("HTTP {}: {}".format(server_response.status_code, response.get("message", response)))
+
+        etag = server_response.headers.get("ETag")
+        last_modified = server_response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self.validated_pages.put(page_url, (etag, last_modified, response))
+        return response
+
+    def iter_entities(self, sub_url, page_size=PAGE_SIZE, params=None, prefetch=False, conditional=False):
+        # Walk a v2 collection page by page and yield its entities one at a time.
+        # With prefetch, the next page is requested while the caller consumes the current one.
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page_index = 0
+            num_fetched = 0
+            response = self.get_page(sub_url, page_index, page_size, params, conditional)
+            while True:
+                entities = response.get("entities") or []
+                grand_total = (response.get("metadata") or {}).get("grand_total_entities")
+                num_fetched += len(entities)
+
+                # A short page, or a collection which ignores paging, is the last one
+                if grand_total is not None:
+                    has_next = 0 < len(entities) and num_fetched < grand_total
+                else:
+                    has_next = len(entities) == page_size
+
+                next_page = None
+                if has_next and executor:
+                    next_page = executor.submit(self.get_page, sub_url, page_index + 1, page_size, params,
+                                                conditional)
+
+                # Drop the page body so that only the entities remain referenced
+                response = None
+                for entity in entities:
+                    yield entity
+                entities = None
+
+                if not has_next:
+                    break
+
+                page_index += 1
+                if next_page:
+                    response = next_page.result()
+                else:
+                    response = self.get_page(sub_url, page_index, page_size, params, conditional)
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def stream_entities(self, sub_url, page_size=PAGE_SIZE, params=None):
+        # Walk a v2 collection page by page like iter_entities, but parse each page
+        # incrementally while it is still arriving. Only the entities are parsed, so the
+        # last page is the first one shorter than page_size.
+        # A transport which cannot stream (e.g. replaying a cassette) gives whole pages instead.
+        streamed = getattr(self.transport, "streaming", False)
+        page_index = 0
+        while True:
+            page_url = self.get_page_url(sub_url, page_index, page_size, params)
+            server_response = self.rest_request(GET, page_url, None, stream=streamed)
+            num_entities = 0
+            try:
+                if server_response.status_code != 200:
+                    raise Exception("HTTP {}: {}".format(server_response.status_code, decode_json(
+                        server_response.content).get("message", "")))
+                for entity in iter_response_entities(server_response, streamed):
+                    num_entities += 1
+                    yield entity
+            finally:
+                server_response.close()
+
+            if num_entities < page_size:
+                break
+            page_index += 1
+
+    def get_entities(self, sub_url, use_cache=True):
+        # Get all the entities of a v2 collection, shared with other callers via the entity cache.
+        # Entities of collections with a model are kept compact as model instances,
+        # made one at a time as the entities of a streamed collection are parsed.
+        # The returned list is shared, so callers must not modify it.
+        if use_cache:
+            entities = self.entity_cache.get(sub_url)
+            if entities is not None:
+                return entities
+
+        if ijson and getattr(self.transport, "streaming", False) and sub_url in STREAMED_COLLECTIONS:
+            raw_entities = self.stream_entities(sub_url)
+        else:
+            raw_entities = self.iter_entities(sub_url, conditional=True)
+        model = ENTITY_MODELS.get(sub_url.split("?")[0])
+        if model:
+            entities = [model(entity, self) for entity in raw_entities]
+        else:
+            entities = list(raw_entities)
+        self.entity_cache.put(sub_url, entities)
+        return entities
+
+
+def build_vm_disk_dto(device_bus, storage_container_uuid=None, size=None):
+    # Build a VMDiskDTO; an IDE disk is an empty CD-ROM, others of size MB are created on the container
+    vm_disk_dto = {
+        "is_cdrom": device_bus == "IDE",
+        "is_empty": device_bus == "IDE",
+        "is_scsi_pass_through": False,
+        "disk_address": {"device_bus": device_bus},
+    }
+    if device_bus != "IDE":
+        vm_disk_dto["vm_disk_create"] = {"storage_container_uuid": storage_container_uuid,
+                                         "size": size * DISK_SIZE_UNIT}
+
+    return vm_disk_dto
+
+
+def build_vm_nic_spec_dto(network_uuid, requested_ip_address=None):
+    # Build a VMNicSpecDTO, requesting the IP address when given
+    vm_nic_spec_dto = {"network_uuid": network_uuid, "request_ip": bool(requested_ip_address)}
+    if requested_ip_address:
+        vm_nic_spec_dto["requested_ip_address"] = requested_ip_address
+
+    return vm_nic_spec_dto
+
+
+def build_vm_config_dto(name, num_vcpus, num_cores_per_vcpu, memory_mb, vm_disks, vm_nics=None):
+    # Build a VmConfigDTO from the VM settings and its VMDiskDTOs and VMNicSpecDTOs
+    vm_config_dto = {
+        "name": name,
+        "num_vcpus": num_vcpus,
+        "num_cores_per_vcpu": num_cores_per_vcpu,
+        "memory_mb": memory_mb,
+        "vm_disks": vm_disks,
+    }
+    if vm_nics:
+        vm_config_dto["vm_nics"] = vm_nics
+
+    return vm_config_dto
 
 
 class ContainersMenu:
     def __init__(self, ntnx_rest_api):
         self.rest_api = ntnx_rest_api
         self.containers = []
+        self.containers_index = NtnxEntityIndex("storage_containers")
 
-    def sync_containers(self):
-        # Sync NTNX storage containers information with the target cluster
+    def sync_containers(self, use_cache=True):
+        # Sync NTNX storage containers information with the target cluster and return what changed
         print("Getting containers information of the cluster {}".format(self.rest_api.cluster_ip_address))
 
-        if NO_CONN:
-            with open(".\\data\\containers.json", "rt") as fin:
-                containers = json.load(fin)
-        else:
-            rest_status, containers = self.rest_api.rest_call(GET, "storage_containers", None)
+        containers = self.rest_api.get_entities("storage_containers", use_cache)
 
         if DEBUG:
-            with open(".\\debug\\containers.json", "wt") as fout:
-                json.dump(containers, fout, indent=2)
+            debug_writer.capture("containers", {"entities": containers})
 
-        self.containers = containers.get("entities").copy()
+        self.containers = containers
+        return self.containers_index.sync(containers)
 
     def get_containers(self):
         # Getter for containers list
@@ -82,13 +963,20 @@ class ContainersMenu:
 
         return self.containers
 
+    def get_containers_index(self):
+        # Getter for containers index
+        if not self.containers:
+            self.sync_containers()
+
+        return self.containers_index
+
     def list_containers(self):
         # Print containers list
         print("#" * 79)
         for entity in self.containers:
-            print("ContainerUuid: {}".format(entity.get("storage_container_uuid")))
-            print("Name: {}".format(entity.get("name")))
-            print("Capacity: {}".format(entity.get("max_capacity")))
+            print("ContainerUuid: {}".format(entity.storage_container_uuid))
+            print("Name: {}".format(entity.name))
+            print("Capacity: {}".format(entity.max_capacity))
             print("-" * 79)
 
     def create_container(self):
@@ -108,8 +996,9 @@ class ContainersMenu:
                 print("Return to Main Menu")
                 break
             elif response == "21":
-                self.sync_containers()
-                self.list_containers()
+                with profiler.operation("list containers"):
+                    print(self.sync_containers(use_cache=False))
+                    self.list_containers()
                 continue
             elif response == "22":
                 continue
@@ -123,22 +1012,19 @@ class NetworksMenu:
     def __init__(self, ntnx_rest_api):
         self.rest_api = ntnx_rest_api
         self.networks = []
+        self.networks_index = NtnxEntityIndex("networks")
 
-    def sync_networks(self):
-        # Sync NTNX networks information with the target cluster
+    def sync_networks(self, use_cache=True):
+        # Sync NTNX networks information with the target cluster and return what changed
         print("Getting networks information of the cluster {}".format(self.rest_api.cluster_ip_address))
 
-        if NO_CONN:
-            with open(".\\data\\networks.json", "rt") as fin:
-                networks = json.load(fin)
-        else:
-            rest_status, networks = self.rest_api.rest_call(GET, "networks", None)
+        networks = self.rest_api.get_entities("networks", use_cache)
 
         if DEBUG:
-            with open(".\\debug\\networks.json", "wt") as fout:
-                json.dump(networks, fout, indent=2)
+            debug_writer.capture("networks", {"entities": networks})
 
-        self.networks = networks.get("entities").copy()
+        self.networks = networks
+        return self.networks_index.sync(networks)
 
     def get_networks(self):
         # Getter for networks list
@@ -147,13 +1033,20 @@ class NetworksMenu:
 
         return self.networks
 
+    def get_networks_index(self):
+        # Getter for networks index
+        if not self.networks:
+            self.sync_networks()
+
+        return self.networks_index
+
     def list_networks(self):
         # Print networks list
         print("#" * 79)
         for entity in self.networks:
-            print("VLAN ID: {}".format(entity.get("vlan_id")))
-            print("Name: {}".format(entity.get("name")))
-            print("NetworkUuid: {}".format(entity.get("uuid")))
+            print("VLAN ID: {}".format(entity.vlan_id))
+            print("Name: {}".format(entity.name))
+            print("NetworkUuid: {}".format(entity.uuid))
             print("-" * 79)
 
     def create_network(self):
@@ -173,8 +1066,9 @@ class NetworksMenu:
                 print("Return to Main Menu")
                 break
             elif response == "31":
-                self.sync_networks()
-                self.list_networks()
+                with profiler.operation("list networks"):
+                    print(self.sync_networks(use_cache=False))
+                    self.list_networks()
                 continue
             elif response == "32":
                 continue
@@ -184,15 +1078,169 @@ class NetworksMenu:
         return
 
 
-class VmCreationMenu:
+def glob_to_regex(pattern):
+    # Translate a shell-style name pattern (* and ?) into a regular expression
+    return "".join(".*" if char == "*" else "." if char == "?" else re.escape(char) for char in pattern)
+
+
+class VmsMenu:
     def __init__(self, ntnx_rest_api):
         self.rest_api = ntnx_rest_api
+        self.vms = []
+        self.page_index = 0
+        self.page_size = VM_LIST_PAGE_SIZE
+        self.models = {}
+        self.vms_index = NtnxEntityIndex("vms")
+
+    def sync_vms(self, use_cache=True):
+        # Sync NTNX VMs information with the target cluster and return what changed since the last sync
+        print("Getting VMs information of the cluster {}".format(self.rest_api.cluster_ip_address))
+
+        vms = self.rest_api.get_entities("vms", use_cache)
+
+        if DEBUG:
+            debug_writer.capture("vms", {"entities": vms})
+
+        return self.vms_index.sync(vms)
+
+    def list_vm_changes(self, change_set):
+        # Print the VMs added, updated and removed by a sync
+        print("#" * 79)
+        print(change_set)
+        for change, vms in (("Added", change_set.added), ("Updated", change_set.updated),
+                            ("Removed", change_set.removed)):
+            for vm in vms:
+                print("{}: {} ({})".format(change, vm.name, vm.uuid))
+
+    def get_vm_model(self, fields=None):
+        # Model keeping only the selected fields, in addition to the UUID and name
+        if not fields:
+            return NtnxVm
+        unknown_fields = [field for field in fields if field not in VM_PROJECTION_FIELDS]
+        if unknown_fields:
+            raise ValueError("Unknown VM fields {}, choose from {}".format(
+                ", ".join(unknown_fields), ", ".join(VM_PROJECTION_FIELDS)))
+        fields = tuple(OrderedDict.fromkeys(["uuid", "name"] + list(fields)))
+        if fields not in self.models:
+            self.models[fields] = make_entity_model("NtnxVmProjection", "vms", fields)
+        return self.models[fields]
+
+    def query_vms(self, power_state=None, name_pattern=None, host_uuid=None, sort_key="name", fields=None):
+        # Query VMs matching all the given filters, sorted by sort_key then UUID for a stable order.
+        # Filters are pushed to the server with the v2 filter parameter and applied again locally,
+        # and disk and NIC configs are left out of the responses as they are not listed.
+        print("Getting VMs information of the cluster {}".format(self.rest_api.cluster_ip_address))
+        filters = {"power_state": power_state, "name_pattern": name_pattern, "host_uuid": host_uuid}
+        fiql = []
+        for filter_name, value in filters.items():
+            if value:
+                if filter_name == "name_pattern":
+                    value = glob_to_regex(value)
+                fiql.append("{}=={}".format(VM_FILTER_ATTRIBUTES[filter_name], value))
+        params = {"include_vm_disk_config": "false", "include_vm_nic_config": "false"}
+        if fiql:
+            params["filter"] = ";".join(fiql)
+
+        model = self.get_vm_model(fields)
+        vms = []
+        for entity in self.rest_api.iter_entities("vms", params=params, prefetch=True):
+            if power_state and str(entity.get("power_state")).lower() != power_state.lower():
+                continue
+            if name_pattern and not fnmatch.fnmatchcase(entity.get("name") or "", name_pattern):
+                continue
+            if host_uuid and entity.get("host_uuid") != host_uuid:
+                continue
+            vms.append(model(entity, self.rest_api))
+
+        if sort_key not in model.field_set:
+            sort_key = "name"
+        vms.sort(key=lambda vm: (vm.get(sort_key) is None, vm.get(sort_key) if vm.get(sort_key) is not None else "",
+                                 vm.uuid or ""))
+
+        self.vms = vms
+        self.page_index = 0
+        return vms
+
+    def list_vms(self):
+        # Print the current page of VMs
+        num_pages = max(1, (len(self.vms) + self.page_size - 1) // self.page_size)
+        first = self.page_index * self.page_size
+        print("#" * 79)
+        for vm in self.vms[first:first + self.page_size]:
+            for field in vm.fields:
+                print("{}: {}".format(field, vm.get(field)))
+            print("-" * 79)
+        print("Page {}/{} ({} VMs)".format(self.page_index + 1, num_pages, len(self.vms)))
+
+    def show_menu(self):
+        while True:
+            print("#" * 79)
+            print("NTNX Cluster VMs Menu")
+            print("41:  List VMs Information")
+            print("42:  Next Page")
+            print("43:  Previous Page")
+            print("44:  Show VM Changes Since Last Sync")
+            print("99:  Return to Main Menu")
+            print("#" * 79)
+            response = input("Please enter VM operation\n")
+
+            if response == "99":
+                print("Return to Main Menu")
+                break
+            elif response == "41":
+                power_state = input("Power state [on/off] (empty for any):")
+                name_pattern = input("Name pattern, e.g. web-* (empty for any):")
+                host_uuid = input("Host UUID (empty for any):")
+                sort_key = input("Sort by [name/num_vcpus/memory_mb/power_state] (empty for name):") or "name"
+                fields = input("Fields to show, comma separated (empty for default):")
+                with profiler.operation("query vms"):
+                    try:
+                        self.query_vms(power_state, name_pattern, host_uuid, sort_key,
+                                       [field.strip() for field in fields.split(",") if field.strip()])
+                    except ValueError as ex:
+                        print(ex)
+                        continue
+                    self.list_vms()
+                continue
+            elif response == "42":
+                if (self.page_index + 1) * self.page_size < len(self.vms):
+                    self.page_index += 1
+                self.list_vms()
+                continue
+            elif response == "43":
+                if self.page_index > 0:
+                    self.page_index -= 1
+                self.list_vms()
+                continue
+            elif response == "44":
+                with profiler.operation("sync vms"):
+                    self.list_vm_changes(self.sync_vms(use_cache=False))
+                continue
+            else:
+                print(response)
+                continue
+        return
+
+
+class VmCreationMenu:
+    def __init__(self, ntnx_rest_api, containers_menu=None, networks_menu=None):
+        # The containers and networks menus may be shared with the main menu, along with their indexes
+        self.rest_api = ntnx_rest_api
+        self.containers_menu = containers_menu or ContainersMenu(self.rest_api)
+        self.networks_menu = networks_menu or NetworksMenu(self.rest_api)
+        self.validator = None
 
     def create_vm(self):
         print("#" * 79)
         print("NTNX Cluster VM Creation Menu")
         print("#" * 79)
 
+        # Disks and IPs are checked against the containers and networks synced once for the VM,
+        # so that its disks share the free space and its NICs the IP pools
+        from ntnx_preflight import NtnxPreflightValidator
+        self.validator = NtnxPreflightValidator(self.rest_api)
+        self.validator.sync()
+
         # Create a VmConfigDTO and create a VM via REST API
         vm_config_dto = {}
         vm_disks = []
@@ -244,38 +1292,60 @@ class VmCreationMenu:
 
         if DEBUG:
             pp.pprint(vm_config_dto)
-            with open(".\\debug\\vm_config_dto.json", "wt") as fout:
-                json.dump(vm_config_dto, fout, indent=2)
+            debug_writer.capture("vm_config_dto", vm_config_dto)
 
-        if not NO_CONN:
+        with profiler.operation("create vm"):
             rest_status, vms = self.rest_api.rest_call(POST, "vms", json.dumps(vm_config_dto))
 
-            if DEBUG:
-                with open(".\\debug\\vms.json", "wt") as fout:
-                    json.dump(vms, fout, indent=2)
+        if DEBUG:
+            debug_writer.capture("vms", vms)
+
+    def clone_vms(self):
+        # Clone a template VM into many VMs named from a pattern
+        from ntnx_vm_clone import NtnxVmCloner, generate_names
+        print("#" * 79)
+        print("NTNX Cluster VM Clone Menu")
+        print("#" * 79)
+
+        while True:
+            source = input("Please enter the Name or UUID of the template VM:")
+            name_pattern = input("Please enter the name pattern of the clones, e.g. vdi-{index:03d}:")
+            try:
+                count = int(input("Please enter number of clones:"))
+                names = generate_names(name_pattern, count)
+            except (KeyError, IndexError, ValueError) as ex:
+                # A pattern with another field than index, e.g. vdi-{x} or vdi-{0}, or a bad format spec
+                print("Name pattern {} is wrong: {!r}".format(name_pattern, ex))
+                continue
+            response = input("Clone {} into {} VMs ({} ...)? [Y/N]:".format(source, count, ", ".join(names[:3])))
+            if response == "Y":
+                break
+
+        try:
+            clone_results = NtnxVmCloner(self.rest_api).run(source, names)
+        except KeyError as ex:
+            print(ex.args[0])
+            return
+        except Exception as ex:
+            print("Cloning {} failed: {}".format(source, ex))
+            return
+
+        for clone_result in clone_results:
+            print("{}: {} {}".format(clone_result["name"], clone_result["status"],
+                                     clone_result.get("task_uuid") or clone_result.get("error") or ""))
 
     def create_vm_disk(self):
         # Create a VMDiskDTO and return it
-        vm_disk_dto = {}
-        vm_disk_address_dto = {}
-        vm_disk_create_dto = {}
+        storage_container_uuid = None
+        disk_size = None
 
         while True:
-            vm_disk_address_dto["device_bus"] = input("Please enter Disk type [SCSI/IDE/PCI]:")
-            if vm_disk_address_dto["device_bus"] not in DISK_TYPE:
+            device_bus = input("Please enter Disk type [SCSI/IDE/PCI]:")
+            if device_bus not in DISK_TYPE:
                 print("Please input [SCSI/IDE/PCI]")
                 continue
 
-            if vm_disk_address_dto["device_bus"] == "IDE":
-                vm_disk_dto["is_cdrom"] = True
-                vm_disk_dto["is_empty"] = True
-            else:
-                vm_disk_dto["is_cdrom"] = False
-                vm_disk_dto["is_empty"] = False
-
-            vm_disk_dto["is_scsi_pass_through"] = False
-
-            print("Device Bus:" + vm_disk_address_dto["device_bus"])
+            print("Device Bus:" + device_bus)
             response = input("Is it OK? [Y/N]:")
 
             if response == "Y":
@@ -285,34 +1355,33 @@ class VmCreationMenu:
 
         # Make user to select ContainerUuid from the list of Container
         while True:
-            if vm_disk_address_dto["device_bus"] == "IDE":
+            if device_bus == "IDE":
                 break
             else:
                 print("Select a container from following containers' list")
                 print("#" * 79)
-                containers_dict = {}
-                containers_list = ContainersMenu(self.rest_api).get_containers()
-                for container in containers_list:
-                    containers_dict[container["name"]] = container
-
-                for container_name in containers_dict.keys():
+                containers_index = self.containers_menu.get_containers_index()
+                for container_name in containers_index.indexes["name"].keys():
                     print(container_name)
 
                 container_name = input("Please enter a Container Name for placing the VM:")
                 disk_size = input("Please enter the size(MB) of disk:")
                 container_confirm = input(container_name + " (" + disk_size + " MB)? [Y/N]:")
                 if container_confirm == "Y":
+                    error = self.validator.check_disk({"device_bus": device_bus, "container": container_name,
+                                                       "size": disk_size})
+                    if error:
+                        print(error)
+                        continue
+                    container = containers_index.get("name", container_name)
                     print(container_name + " is selected")
-                    vm_disk_create_dto["storage_container_uuid"] = \
-                        containers_dict[container_name].get("storage_container_uuid")
-                    vm_disk_create_dto["size"] = int(disk_size)
+                    storage_container_uuid = container.storage_container_uuid
+                    disk_size = int(disk_size)
                     break
                 else:
                     continue
 
-        vm_disk_dto["disk_address"] = vm_disk_address_dto
-        if vm_disk_address_dto["device_bus"] != "IDE":
-            vm_disk_dto["vm_disk_create"] = vm_disk_create_dto
+        vm_disk_dto = build_vm_disk_dto(device_bus, storage_container_uuid, disk_size)
 
         if DEBUG:
             pp.pprint(vm_disk_dto)
@@ -321,45 +1390,52 @@ class VmCreationMenu:
 
     def create_vm_nic(self):
         # Create a VMNicSpecDTO and return it
-        vm_nic_spec_dto = {}
+        request_ip_address = None
 
         # Make user to select NetworkUuid from the list of Network
         while True:
             print("Select a network from following networks' list")
             print("#" * 79)
-            networks_dict = {}
-            networks_list = NetworksMenu(self.rest_api).get_networks()
-            for network in networks_list:
-                networks_dict[network["name"]] = network
-
-            for network_name in networks_dict.keys():
-                display_net_address = str(networks_dict[network_name].get("ip_config").get("network_address"))
-                print(network_name + ":" + display_net_address)
+            networks_index = self.networks_menu.get_networks_index()
+            for network in self.networks_menu.get_networks():
+                display_net_address = str((network.ip_config or {}).get("network_address"))
+                print(network.name + ":" + display_net_address)
 
             network_name = input("Please enter a Container Name for placing VM:")
             network_confirm = input(network_name + "? [Y/N]:")
             if network_confirm == "Y":
+                try:
+                    network = networks_index.get("name", network_name)
+                except (KeyError, ValueError) as ex:
+                    print(ex)
+                    continue
                 print(network_name + " is selected")
-                vm_nic_spec_dto["uuid"] = networks_dict[network_name].get("uuid")
+                network_uuid = network.uuid
                 break
             else:
                 continue
 
         while True:
-            vm_nic_spec_dto["request_ip"] = False
             network_confirm = input("Do you want to request IP address?[Y/N]:")
             if network_confirm == "Y":
                 request_ip_address = input("Please enter request IP address(xxx.xxx.xxx.xxx):")
                 ip_address_confirm = input("IP Address: " + request_ip_address + "\nIs it OK? [Y/N]:")
                 if ip_address_confirm == "Y":
-                    vm_nic_spec_dto["requested_ip_address"] = request_ip_address
-                    vm_nic_spec_dto["request_ip"] = True
+                    error = self.validator.check_nic({"network": network_name,
+                                                      "requested_ip_address": request_ip_address})
+                    if error:
+                        print(error)
+                        request_ip_address = None
+                        continue
                     break
                 else:
+                    request_ip_address = None
                     continue
             else:
                 break
 
+        vm_nic_spec_dto = build_vm_nic_spec_dto(network_uuid, request_ip_address)
+
         if DEBUG:
             pp.pprint(vm_nic_spec_dto)
 
@@ -378,20 +1454,45 @@ class MainMenu:
 
         self.rest_api = NtnxRestApiSession(tgt_cluster_ip, tgt_username, tgt_password)
         self.cluster = None
+        # Menus are kept between visits, so that their indexes report the changes since the last sync
+        self.containers_menu = ContainersMenu(self.rest_api)
+        self.networks_menu = NetworksMenu(self.rest_api)
+        self.vms_menu = VmsMenu(self.rest_api)
+        self.vm_creation_menu = VmCreationMenu(self.rest_api, self.containers_menu, self.networks_menu)
+        if INVENTORY_WARM_START:
+            self.warm_start()
+
+    def warm_start(self):
+        # Load containers and networks from the local inventory snapshot, refreshed in the background.
+        # The snapshot may be stale until the refresh is done; turn it off with INVENTORY_WARM_START.
+        from ntnx_inventory_store import NtnxInventoryStore
+        self.inventory_store = NtnxInventoryStore()
+        self.inventory_store.warm_start(self.rest_api)
+
+    def watch(self):
+        # Print inventory change events until interrupted with Ctrl-C
+        from ntnx_watch import NtnxWatcher
+        watcher = NtnxWatcher(self.rest_api, [lambda event: print("{event} {collection} {name} ({uuid})".format(
+            **event))])
+        print("Watching the cluster {}, press Ctrl-C to return".format(self.rest_api.cluster_ip_address))
+        self.rest_api.verbose = False
+        watcher.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            watcher.stop()
+        finally:
+            self.rest_api.verbose = True
 
     def get_cluster(self):
         # Sync a specific NTNX cluster information with the target cluster and print it out
         print("Getting cluster information of the cluster {}".format(self.rest_api.cluster_ip_address))
 
-        if NO_CONN:
-            with open(".\\data\\cluster.json", "rt") as fin:
-                self.cluster = json.load(fin)
-        else:
-            rest_status, self.cluster = self.rest_api.rest_call(GET, "cluster", None)
+        rest_status, self.cluster = self.rest_api.rest_call(GET, "cluster", None)
 
         if DEBUG:
-            with open(".\\debug\\cluster.json", "wt") as fout:
-                json.dump(self.cluster, fout, indent=2)
+            debug_writer.capture("cluster", self.cluster)
 
         print("#" * 79)
         print("Name: {}".format(self.cluster.get("name")))
@@ -423,6 +1524,9 @@ class MainMenu:
                 print("3:  Network Operation")
                 print("4:  VMs Operation")
                 print("5:  Create a VM")
+                print("6:  Show REST API Metrics")
+                print("7:  Clone VMs from a Template")
+                print("8:  Watch Inventory Changes")
                 print("99: Exit Menu")
                 print("#" * 79)
                 response = input("Please enter cluster operation\n")
@@ -431,18 +1535,33 @@ class MainMenu:
                     print("NTNX Cluster Handler Exit")
                     break
                 elif response == "1":
-                    self.get_cluster()
+                    with profiler.operation("get cluster"):
+                        self.get_cluster()
                     continue
                 elif response == "2":
-                    ContainersMenu(self.rest_api).show_menu()
+                    self.containers_menu.show_menu()
                     continue
                 elif response == "3":
-                    NetworksMenu(self.rest_api).show_menu()
+                    self.networks_menu.show_menu()
                     continue
                 elif response == "4":
+                    self.vms_menu.show_menu()
                     continue
                 elif response == "5":
-                    VmCreationMenu(self.rest_api).create_vm()
+                    self.vm_creation_menu.create_vm()
+                    continue
+                elif response == "7":
+                    with profiler.operation("clone vms"):
+                        self.vm_creation_menu.clone_vms()
+                    continue
+                elif response == "8":
+                    self.watch()
+                    continue
+                elif response == "6":
+                    print(self.rest_api.metrics.to_prometheus())
+                    for operation, phases in profiler.report().items():
+                        print("{}: {}".format(operation, ", ".join(
+                            "{} {:.3f}s".format(phase, seconds) for phase, seconds in phases.items())))
                     continue
                 else:
                     print(response)
@@ -0,0 +1,193 @@
+############################################################
+#
+#  Script: Model Nutanix Cluster entities
+#  Author: Yukiya Shimizu
+#  Description: Compact entity models and indexes of v2 collections
+#  Language: Python3
+#
+############################################################
+
+import hashlib
+import json
+
+GET = "get"
+
+# UUID key and indexed keys of the entities of each v2 collection
+ENTITY_KEYS = {
+    "storage_containers": ("storage_container_uuid", ["name"]),
+    "networks": ("uuid", ["name", "vlan_id"]),
+    "vms": ("uuid", ["name"]),
+    "hosts": ("uuid", ["name"]),
+}
+# Fields kept by the entity models of each v2 collection, the rest is fetched on demand
+ENTITY_FIELDS = {
+    "storage_containers": ["storage_container_uuid", "name", "max_capacity", "usage_stats"],
+    "networks": ["uuid", "name", "vlan_id", "ip_config"],
+    "vms": ["uuid", "name", "num_vcpus", "num_cores_per_vcpu", "memory_mb", "power_state", "host_uuid"],
+}
+
+
+def get_fingerprint(entity):
+    # Digest of the whole entity, which changes whenever any of its fields does
+    entity_json = json.dumps(entity, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(entity_json.encode("utf-8"), digest_size=16).digest()
+
+
+class NtnxChangeSet:
+    def __init__(self, collection):
+        # Entities added, updated and removed by a sync of a collection
+        self.collection = collection
+        self.added = []
+        self.updated = []
+        self.removed = []
+
+    def __bool__(self):
+        return bool(self.added or self.updated or self.removed)
+
+    def __str__(self):
+        return "{}: {} added, {} updated, {} removed".format(
+            self.collection, len(self.added), len(self.updated), len(self.removed))
+
+
+class NtnxEntity:
+    # Compact model of an entity which keeps only the fields of its collection in ENTITY_FIELDS.
+    # The full payload is fetched from the cluster when asked for.
+    __slots__ = ("rest_api", "fingerprint")
+    collection = None
+    uuid_key = None
+    fields = ()
+    field_set = frozenset()
+
+    def __init__(self, entity, rest_api=None):
+        # The fingerprint covers only the kept fields, so that a model restored from
+        # a snapshot of these fields matches the model of the unchanged live entity
+        self.rest_api = rest_api
+        for field in self.fields:
+            setattr(self, field, entity.get(field))
+        self.fingerprint = get_fingerprint(self.to_dict())
+
+    def get(self, field, default=None):
+        # Dict-like access to the kept fields, so that a model can stand in for a response dict
+        if field in self.field_set:
+            return getattr(self, field)
+        return default
+
+    def __getitem__(self, field):
+        if field not in self.field_set:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.to_dict())
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def get_payload(self):
+        # Fetch the full entity from the cluster
+        rest_status, payload = self.rest_api.rest_call(GET, "{}/{}".format(
+            self.collection, getattr(self, self.uuid_key)), None)
+        return payload
+
+
+def make_entity_model(class_name, collection, fields):
+    # Create a slotted model class keeping the given fields of the collection's entities
+    fields = tuple(fields)
+    return type(class_name, (NtnxEntity,), {
+        "__slots__": fields,
+        "collection": collection,
+        "uuid_key": ENTITY_KEYS[collection][0],
+        "fields": fields,
+        "field_set": frozenset(fields),
+    })
+
+
+NtnxContainer = make_entity_model("NtnxContainer", "storage_containers", ENTITY_FIELDS["storage_containers"])
+NtnxNetwork = make_entity_model("NtnxNetwork", "networks", ENTITY_FIELDS["networks"])
+NtnxVm = make_entity_model("NtnxVm", "vms", ENTITY_FIELDS["vms"])
+ENTITY_MODELS = {
+    "storage_containers": NtnxContainer,
+    "networks": NtnxNetwork,
+    "vms": NtnxVm,
+}
+
+
+class NtnxEntityIndex:
+    def __init__(self, collection):
+        # Entities of a collection indexed by UUID and by each of the indexed keys,
+        # with the fingerprint of each entity to detect changes on re-sync
+        self.collection = collection
+        self.uuid_key, self.index_keys = ENTITY_KEYS[collection]
+        self.entities = {}
+        self.fingerprints = {}
+        self.indexes = {key: {} for key in self.index_keys}
+
+    def add_to_indexes(self, uuid, entity):
+        for key in self.index_keys:
+            self.indexes[key].setdefault(entity.get(key), set()).add(uuid)
+
+    def remove_from_indexes(self, uuid, entity):
+        for key in self.index_keys:
+            uuids = self.indexes[key].get(entity.get(key))
+            if uuids is None:
+                continue
+            uuids.discard(uuid)
+            if not uuids:
+                del self.indexes[key][entity.get(key)]
+
+    def sync(self, entities):
+        # Apply only the added, changed and removed entities to the collection and its indexes,
+        # and return them as a change set
+        change_set = NtnxChangeSet(self.collection)
+        synced_uuids = set()
+        for entity in entities:
+            uuid = entity.get(self.uuid_key)
+            synced_uuids.add(uuid)
+            indexed_entity = self.entities.get(uuid)
+            if indexed_entity is entity:
+                continue
+
+            fingerprint = getattr(entity, "fingerprint", None)
+            if fingerprint is None:
+                fingerprint = get_fingerprint(entity)
+            if indexed_entity is not None:
+                if self.fingerprints[uuid] == fingerprint:
+                    continue
+                self.remove_from_indexes(uuid, indexed_entity)
+                change_set.updated.append(entity)
+            else:
+                change_set.added.append(entity)
+            self.entities[uuid] = entity
+            self.fingerprints[uuid] = fingerprint
+            self.add_to_indexes(uuid, entity)
+
+        for uuid in set(self.entities.keys()) - synced_uuids:
+            removed_entity = self.entities.pop(uuid)
+            del self.fingerprints[uuid]
+            self.remove_from_indexes(uuid, removed_entity)
+            change_set.removed.append(removed_entity)
+
+        for name, uuids in self.duplicates("name").items():
+            print("Duplicate {} name {}: {}".format(self.collection, name, ", ".join(sorted(uuids))))
+        return change_set
+
+    def duplicates(self, key):
+        # Values of the key shared by more than one entity, with their UUIDs
+        return {value: uuids for value, uuids in self.indexes[key].items() if len(uuids) > 1}
+
+    def get_by_uuid(self, uuid):
+        return self.entities.get(uuid)
+
+    def find(self, key, value):
+        # All the entities whose key has the value
+        return [self.entities[uuid] for uuid in self.indexes[key].get(value, ())]
+
+    def get(self, key, value):
+        # The single entity whose key has the value
+        uuids = self.indexes[key].get(value)
+        if not uuids:
+            raise KeyError("No {} found with {} {}".format(self.collection, key, value))
+        if len(uuids) > 1:
+            raise ValueError("{} {} with {} {}: {}".format(
+                len(uuids), self.collection, key, value, ", ".join(sorted(uuids))))
+        return self.entities[next(iter(uuids))]
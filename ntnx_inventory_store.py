@@ -0,0 +1,191 @@
+############################################################
+#
+#  Script: Keep Nutanix Cluster inventory in a local SQLite store
+#  Author: Yukiya Shimizu
+#  Description: Snapshot clusters, containers, networks and VMs for local queries
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from ntnx_cluster_bak2 import GET
+from ntnx_entities import ENTITY_KEYS, ENTITY_MODELS
+
+INVENTORY_DB = os.path.join("data", "inventory.db")
+# Kinds of entities kept in the store, "cluster" being the cluster itself
+INVENTORY_KINDS = ["cluster", "storage_containers", "networks", "vms"]
+# Collections loaded into the session at warm start, refreshed in the background afterwards
+WARM_START_KINDS = ["storage_containers", "networks"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    cluster TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    num_entities INTEGER NOT NULL,
+    PRIMARY KEY (cluster, kind)
+);
+CREATE TABLE IF NOT EXISTS entities (
+    cluster TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    name TEXT,
+    body TEXT NOT NULL,
+    PRIMARY KEY (cluster, kind, uuid)
+);
+CREATE INDEX IF NOT EXISTS entities_uuid ON entities (uuid);
+CREATE INDEX IF NOT EXISTS entities_name ON entities (kind, name);
+"""
+
+
+def get_entity_uuid(kind, entity):
+    if kind == "cluster":
+        return entity.get("uuid") or entity.get("id")
+    return entity.get(ENTITY_KEYS[kind][0])
+
+
+class NtnxInventoryStore:
+    def __init__(self, db_file=INVENTORY_DB):
+        # Snapshots of the entities of each cluster, indexed by UUID, name and cluster
+        if os.path.dirname(db_file):
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+
+    def save_snapshot(self, cluster, kind, entities):
+        # Replace the snapshot of a kind of entities of the cluster in a single transaction
+        # Raw entities are kept only as far as the fields of their model
+        model = ENTITY_MODELS.get(kind)
+        rows = []
+        for entity in entities:
+            if hasattr(entity, "to_dict"):
+                entity_dict = entity.to_dict()
+            elif model:
+                entity_dict = {field: entity.get(field) for field in model.fields}
+            else:
+                entity_dict = entity
+            rows.append((cluster, kind, get_entity_uuid(kind, entity), entity.get("name"),
+                         json.dumps(entity_dict, separators=(",", ":"))))
+
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM entities WHERE cluster = ? AND kind = ?", (cluster, kind))
+            self.connection.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)",
+                                    (cluster, kind, time.time(), len(rows)))
+
+    def load_snapshot(self, cluster, kind):
+        # Return the sync time and the entities of a snapshot, or (None, []) when there is none
+        with self.lock:
+            snapshot = self.connection.execute("SELECT synced_at FROM snapshots WHERE cluster = ? AND kind = ?",
+                                               (cluster, kind)).fetchone()
+            if snapshot is None:
+                return None, []
+            rows = self.connection.execute("SELECT body FROM entities WHERE cluster = ? AND kind = ?",
+                                           (cluster, kind)).fetchall()
+        return snapshot["synced_at"], [json.loads(row["body"]) for row in rows]
+
+    def get_snapshots(self):
+        # Sync time and size of every snapshot
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(
+                "SELECT * FROM snapshots ORDER BY cluster, kind").fetchall()]
+
+    def find(self, kind, name):
+        # Entities of the kind with the name across all the clusters, as (cluster, entity)
+        with self.lock:
+            rows = self.connection.execute("SELECT cluster, body FROM entities WHERE kind = ? AND name = ?",
+                                           (kind, name)).fetchall()
+        return [(row["cluster"], json.loads(row["body"])) for row in rows]
+
+    def find_by_uuid(self, uuid):
+        # Entities with the UUID across all the clusters and kinds, as (cluster, kind, entity)
+        with self.lock:
+            rows = self.connection.execute("SELECT cluster, kind, body FROM entities WHERE uuid = ?",
+                                           (uuid,)).fetchall()
+        return [(row["cluster"], row["kind"], json.loads(row["body"])) for row in rows]
+
+    def get_clusters_with(self, kind, name):
+        # Clusters which have an entity of the kind with the name, e.g. a container
+        return sorted(set(cluster for cluster, entity in self.find(kind, name)))
+
+    def sync_cluster(self, rest_api, kinds=INVENTORY_KINDS):
+        # Take a fresh snapshot of the kinds of entities of a cluster
+        for kind in kinds:
+            if kind == "cluster":
+                rest_status, cluster = rest_api.rest_call(GET, "cluster", None)
+                entities = [cluster] if rest_status == 200 else []
+            else:
+                entities = rest_api.get_entities(kind, use_cache=False)
+            self.save_snapshot(rest_api.cluster_ip_address, kind, entities)
+
+    def warm_start(self, rest_api, kinds=WARM_START_KINDS):
+        # Serve the collections from their snapshots through the session's entity cache,
+        # and refresh the snapshots of these collections from the cluster on a background thread
+        for kind in kinds:
+            synced_at, entities = self.load_snapshot(rest_api.cluster_ip_address, kind)
+            if synced_at is None:
+                continue
+            print("Using {} snapshot of {}".format(
+                kind, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(synced_at))))
+            model = ENTITY_MODELS.get(kind)
+            rest_api.entity_cache.put(kind, [model(entity, rest_api) for entity in entities] if model else entities)
+
+        refresher = threading.Thread(target=self.refresh, args=(rest_api, kinds), daemon=True)
+        refresher.start()
+        return refresher
+
+    def refresh(self, rest_api, kinds):
+        try:
+            self.sync_cluster(rest_api, kinds)
+        except Exception as ex:
+            print("Refreshing the inventory snapshot of {} failed: {}".format(rest_api.cluster_ip_address, ex))
+
+    def save_fanout_results(self, results):
+        # Save the merged results of NtnxClusterGroup.query() as snapshots per cluster
+        for kind, entities in results.items():
+            per_cluster = {}
+            for entity in entities:
+                per_cluster.setdefault(entity.get("cluster_ip_address"), []).append(entity)
+            for cluster, cluster_entities in per_cluster.items():
+                self.save_snapshot(cluster, kind, cluster_entities)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the local NTNX inventory store")
+    parser.add_argument("--db", default=INVENTORY_DB)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sweep_parser = subparsers.add_parser("sweep", help="snapshot many clusters concurrently")
+    sweep_parser.add_argument("clusters", help="JSON file of cluster endpoints and credentials")
+    find_parser = subparsers.add_parser("find", help="find entities by name across clusters")
+    find_parser.add_argument("kind", choices=INVENTORY_KINDS)
+    find_parser.add_argument("name")
+    uuid_parser = subparsers.add_parser("uuid", help="find entities by UUID across clusters")
+    uuid_parser.add_argument("uuid")
+    subparsers.add_parser("status", help="list the snapshots and their sync times")
+    args = parser.parse_args()
+
+    store = NtnxInventoryStore(args.db)
+    if args.command == "sweep":
+        from ntnx_multi_cluster import NtnxClusterGroup, load_endpoints
+        sweep_results, sweep_errors = NtnxClusterGroup(load_endpoints(args.clusters)).sweep()
+        store.save_fanout_results(sweep_results)
+        for cluster_ip, query_name, error in sweep_errors:
+            print("Failed {} on {}: {}".format(query_name, cluster_ip, error))
+    elif args.command == "find":
+        for found_cluster, found_entity in store.find(args.kind, args.name):
+            print("{}: {}".format(found_cluster, json.dumps(found_entity)))
+    elif args.command == "uuid":
+        for found_cluster, found_kind, found_entity in store.find_by_uuid(args.uuid):
+            print("{} {}: {}".format(found_cluster, found_kind, json.dumps(found_entity)))
+    else:
+        for snapshot in store.get_snapshots():
+            print("{cluster} {kind}: {num_entities} entities synced at {synced_at}".format(**snapshot))
@@ -0,0 +1,292 @@
+############################################################
+#
+#  Script: Run bulk Nutanix operations as resumable jobs via REST API (v2)
+#  Author: Yukiya Shimizu
+#  Description: Checkpoint create/clone/power/reconcile items in a journal and resume them
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ntnx_cluster_bak2 import NtnxRestApiSession, NtnxEntityIndex
+from ntnx_tasks import NtnxTaskTracker, task_succeeded, task_entity_uuids
+from ntnx_vm_batch import NtnxVmBatch, load_vm_specs
+from ntnx_vm_clone import NtnxVmCloner, generate_names
+from ntnx_vm_power import NtnxVmPowerOperation, TARGET_POWER_STATES, TRANSITIONS
+from ntnx_reconciler import NtnxReconciler, load_desired_state
+
+JOB_WORKERS = 8
+# A new journal is made per run in this directory, unless a run resumes the journal of an earlier one
+JOURNAL_DIR = os.path.join("data", "jobs")
+DONE = "DONE"
+FAILED = "FAILED"
+
+
+def wait_task(task_future):
+    # Wait for a tracked task and return it, raising when it failed
+    if task_future is None:
+        return None
+    task = task_future.result()
+    if not task_succeeded(task):
+        raise Exception((task.get("meta_response") or {}).get("error_detail") or task.get("progress_status"))
+    return task
+
+
+def get_journal_file(command, journal_dir=JOURNAL_DIR):
+    # Path of a new journal for a run of the command, e.g. data/jobs/clone-20240401-093000-1234.jsonl
+    return os.path.join(journal_dir, "{}-{}-{}.jsonl".format(command, time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+
+
+class NtnxJobJournal:
+    def __init__(self, journal_file):
+        # Append-only JSONL of the state of each item, the last line of an item being its state.
+        # Every line is flushed to disk before the next item is recorded, so a crash loses nothing recorded.
+        if os.path.dirname(journal_file):
+            os.makedirs(os.path.dirname(journal_file), exist_ok=True)
+        self.journal_file = journal_file
+        self.records = {}
+        if os.path.exists(journal_file):
+            with open(journal_file, "rt") as fin:
+                for line in fin:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line torn by a crash while it was written
+                        continue
+                    self.records[record["item"]] = record
+        self.fout = open(journal_file, "at")
+
+    def is_done(self, item):
+        record = self.records.get(item)
+        return record is not None and record["state"] == DONE
+
+    def record(self, item, state, result=None, error=None):
+        record = {"item": item, "state": state, "time": time.time(), "result": result, "error": error}
+        self.records[item] = record
+        self.fout.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+
+    def close(self):
+        self.fout.close()
+
+
+class NtnxJobRunner:
+    def __init__(self, journal, max_workers=JOB_WORKERS):
+        # Items are I/O bound REST calls sharing sessions and task trackers, so they run on threads
+        self.journal = journal
+        self.max_workers = max_workers
+
+    def run(self, job):
+        # Run the items of the job not done yet, phase by phase, checkpointing each item as it finishes.
+        # On Ctrl-C, the running items are let finish and recorded before the interrupt is raised again.
+        # Returns the items of the job, done now or before, as the journal may hold items of other jobs.
+        job_items = []
+        for phase in job.get_phases():
+            job_items.extend(item for item, payload in phase)
+            items = [(item, payload) for item, payload in phase if not self.journal.is_done(item)]
+            if len(items) < len(phase):
+                print("Skipping {} of {} items already done".format(len(phase) - len(items), len(phase)))
+            self.run_items(job, items)
+        return job_items
+
+    def run_items(self, job, items):
+        items = iter(items)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while True:
+                    # Keep the pool busy without queueing every item, so that an interrupt leaves little behind
+                    for item, payload in items:
+                        running[executor.submit(job.run_item, payload)] = item
+                        if len(running) >= self.max_workers * 2:
+                            break
+                    if not running:
+                        break
+                    done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                    self.record(running, done)
+            except KeyboardInterrupt:
+                print("Interrupted, finishing {} running items. Run again with --resume {} to resume".format(
+                    len(running), self.journal.journal_file))
+                for future in running:
+                    future.cancel()
+                done, not_done = wait(running)
+                self.record(running, [future for future in done if not future.cancelled()])
+                raise
+
+    def record(self, running, done):
+        for future in done:
+            item = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as ex:
+                print("{}: {} {}".format(item, FAILED, ex))
+                self.journal.record(item, FAILED, error=str(ex))
+                continue
+            print("{}: {}".format(item, DONE))
+            self.journal.record(item, DONE, result)
+
+
+class NtnxCreateJob:
+    def __init__(self, ntnx_rest_api, vm_specs, task_tracker=None):
+        # Create a VM per spec, skipping VMs created before an interruption by their names
+        self.batch = NtnxVmBatch(ntnx_rest_api, task_tracker=task_tracker)
+        self.vm_specs = vm_specs
+        self.vms_index = NtnxEntityIndex("vms")
+
+    def get_phases(self):
+        self.batch.sync_indexes()
+        self.vms_index.sync(self.batch.rest_api.get_entities("vms", use_cache=False))
+        return [[("{} create {}".format(self.batch.rest_api.cluster_ip_address, vm_spec["name"]), vm_spec)
+                 for vm_spec in self.vm_specs]]
+
+    def run_item(self, vm_spec):
+        if self.vms_index.find("name", vm_spec["name"]):
+            return {"status": "EXISTS"}
+        task_uuid, task_future = self.batch.create_vm(self.batch.build_vm_config_dto(vm_spec))
+        task = wait_task(task_future)
+        return {"task_uuid": task_uuid, "vm_uuid": next(iter(task_entity_uuids(task, "VM")), None) if task else None}
+
+
+class NtnxCloneJob:
+    def __init__(self, ntnx_rest_api, source, names, overrides=None, task_tracker=None):
+        # Clone the source VM into the names a batch per call (see NtnxVmCloner),
+        # skipping clones made before an interruption by their names
+        self.cloner = NtnxVmCloner(ntnx_rest_api, task_tracker=task_tracker)
+        self.source = source
+        self.names = names
+        self.overrides = overrides or {}
+        self.source_uuid = None
+
+    def get_phases(self):
+        # Batches are cut from all the names, so that an item stays the same when the job is resumed
+        self.source_uuid = self.cloner.resolve_source(self.source)
+        batch_size = self.cloner.batch_size
+        batches = [self.names[first:first + batch_size] for first in range(0, len(self.names), batch_size)]
+        return [[("{} clone {}..{}".format(self.cloner.rest_api.cluster_ip_address, batch[0], batch[-1]), batch)
+                 for batch in batches]]
+
+    def run_item(self, names):
+        names = [name for name in names if not self.cloner.vms_index.find("name", name)]
+        if not names:
+            return {"status": "EXISTS"}
+        task_uuid, task_future = self.cloner.clone_vms(self.source_uuid, names, self.overrides)
+        wait_task(task_future)
+        return {"task_uuid": task_uuid, "names": names}
+
+
+class NtnxPowerJob:
+    def __init__(self, ntnx_rest_api, vm_uuids, transition, task_tracker=None):
+        # Apply a transition to the VMs, leaving out those already in the target state.
+        # Waves are not kept, the worker pool and rate limit bounding the VMs changed at once.
+        self.power_operation = NtnxVmPowerOperation(ntnx_rest_api, task_tracker=task_tracker)
+        self.vm_uuids = vm_uuids
+        self.transition = transition
+
+    def get_phases(self):
+        target = TARGET_POWER_STATES.get(self.transition)
+        return [[("{} {} {}".format(self.power_operation.rest_api.cluster_ip_address, self.transition, vm.uuid),
+                  vm.uuid)
+                 for vm in self.power_operation.select_vms(self.vm_uuids)
+                 if not target or str(vm.power_state).lower() != target]]
+
+    def run_item(self, vm_uuid):
+        task_uuid, task_future = self.power_operation.submit(vm_uuid, self.transition)
+        wait_task(task_future)
+        return {"task_uuid": task_uuid}
+
+
+class NtnxReconcileJob:
+    def __init__(self, reconciler):
+        # Apply the plan of a reconciler, containers and networks before the VMs referring to them.
+        # Steps done before an interruption are no longer in the plan when it is made again.
+        self.reconciler = reconciler
+
+    def get_phases(self):
+        steps = self.reconciler.plan()
+        return [[(str(step), step) for step in steps if step.kind != "vms"],
+                [(str(step), step) for step in steps if step.kind == "vms"]]
+
+    def run_item(self, step):
+        # A step whose dependencies failed fails too, as NtnxReconciler.execute skips it.
+        # Dependencies are in the first phase, so they are all done by then.
+        failed = [str(dependency) for dependency in step.depends_on if dependency.status in ("FAILED", "SKIPPED")]
+        if failed:
+            step.status = "SKIPPED"
+            raise Exception("Dependency failed: {}".format(", ".join(failed)))
+        try:
+            step.status = step.cluster_state.apply(step)
+        except Exception:
+            step.status = "FAILED"
+            raise
+        return {"status": step.status}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a bulk NTNX operation as a resumable job")
+    parser.add_argument("--journal-dir", default=JOURNAL_DIR, help="directory of the journal made for this run")
+    parser.add_argument("--resume", metavar="JOURNAL", help="journal of an interrupted run of the same job to resume")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS)
+    parser.add_argument("--wait", action="store_true", help="wait for the tasks of the items to complete")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    create_parser = subparsers.add_parser("create", help="create VMs from a JSON/CSV spec file")
+    create_parser.add_argument("cluster_ip")
+    create_parser.add_argument("username")
+    create_parser.add_argument("spec")
+    clone_parser = subparsers.add_parser("clone", help="clone VMs from a template VM")
+    clone_parser.add_argument("cluster_ip")
+    clone_parser.add_argument("username")
+    clone_parser.add_argument("source", help="name or UUID of the template VM")
+    clone_parser.add_argument("name_pattern", help="names of the clones, e.g. vdi-{index:03d}")
+    clone_parser.add_argument("count", type=int)
+    power_parser = subparsers.add_parser("power", help="change the power state of VMs")
+    power_parser.add_argument("cluster_ip")
+    power_parser.add_argument("username")
+    power_parser.add_argument("transition", choices=TRANSITIONS)
+    power_parser.add_argument("uuids", help="file of VM UUIDs, one per line")
+    reconcile_parser = subparsers.add_parser("reconcile", help="apply a desired-state document")
+    reconcile_parser.add_argument("desired_state")
+    args = parser.parse_args()
+    if args.resume and not os.path.exists(args.resume):
+        parser.error("Journal {} does not exist".format(args.resume))
+    if args.command == "clone":
+        try:
+            clone_names = generate_names(args.name_pattern, args.count)
+        except (KeyError, IndexError, ValueError) as ex:
+            parser.error("Name pattern {} is wrong: {!r}".format(args.name_pattern, ex))
+
+    if args.command == "reconcile":
+        bulk_job = NtnxReconcileJob(NtnxReconciler(
+            [(NtnxRestApiSession(cluster["ip_address"], cluster["username"], cluster["password"],
+                                 pool_maxsize=args.workers + 1), cluster)
+             for cluster in load_desired_state(args.desired_state)], args.workers, args.wait))
+    else:
+        password = input("Please enter password for the username\n")
+        rest_api = NtnxRestApiSession(args.cluster_ip, args.username, password, pool_maxsize=args.workers + 1)
+        job_tracker = NtnxTaskTracker(rest_api) if args.wait else None
+        if args.command == "create":
+            bulk_job = NtnxCreateJob(rest_api, load_vm_specs(args.spec), job_tracker)
+        elif args.command == "clone":
+            bulk_job = NtnxCloneJob(rest_api, args.source, clone_names, task_tracker=job_tracker)
+        else:
+            with open(args.uuids, "rt") as fin:
+                bulk_job = NtnxPowerJob(rest_api, [line.strip() for line in fin if line.strip()], args.transition,
+                                        job_tracker)
+
+    job_journal = NtnxJobJournal(args.resume or get_journal_file(args.command, args.journal_dir))
+    print("Journal: {}".format(job_journal.journal_file))
+    try:
+        job_items = NtnxJobRunner(job_journal, args.workers).run(bulk_job)
+    except KeyboardInterrupt:
+        exit(1)
+    finally:
+        job_journal.close()
+
+    num_done = sum(1 for job_item in job_items if job_journal.is_done(job_item))
+    print("#" * 79)
+    print("{} items done, {} failed".format(num_done, len(job_items) - num_done))
+    print("Journal: {}".format(job_journal.journal_file))
@@ -0,0 +1,140 @@
+############################################################
+#
+#  Script: Query many Nutanix Clusters concurrently via REST API (v2)
+#  Author: Yukiya Shimizu
+#  Description: Fan out the same query to many clusters
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, wait
+from urllib.parse import urlencode
+from ntnx_cluster_bak2 import NtnxRestApiSession, NtnxMetrics, GET
+
+# Queries run at once per cluster, so that a slow cluster only holds up its own queries
+CLUSTER_WORKERS = 4
+FANOUT_TIMEOUT = 120
+# Queries which can be fanned out, and whether they return a collection of entities
+CLUSTER_QUERIES = {"cluster": False, "hosts": True, "storage_containers": True, "networks": True, "vms": True}
+# Queries of an inventory sweep, hosts being only queried on demand (e.g. by ntnx_analytics)
+SWEEP_QUERIES = ["cluster", "storage_containers", "networks", "vms"]
+CLUSTER_TAG = "cluster_ip_address"
+
+
+class NtnxClusterGroup:
+    def __init__(self, endpoints, max_workers=CLUSTER_WORKERS, timeout=FANOUT_TIMEOUT):
+        # endpoints is a list of (ip_address, username, password), and max_workers is per cluster
+        # All the sessions record into the same metrics, labelled by cluster
+        self.metrics = NtnxMetrics()
+        self.sessions = [NtnxRestApiSession(*endpoint, metrics=self.metrics) for endpoint in endpoints]
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+    @staticmethod
+    def query_cluster(rest_api, sub_url, params=None):
+        # Run a query with its query parameters against one cluster and tag a copy of every result
+        # with the cluster, as the responses of coalesced GETs are shared with the other callers
+        if CLUSTER_QUERIES[sub_url]:
+            results = rest_api.iter_entities(sub_url, params=params)
+        else:
+            rest_status, response = rest_api.rest_call(GET, sub_url + ("?" + urlencode(params) if params else ""),
+                                                       None)
+            results = [response]
+
+        return [dict(result, **{CLUSTER_TAG: rest_api.cluster_ip_address}) for result in results]
+
+    def run_worker(self, work_queue):
+        # Worker thread of a cluster, running its queries until the queue runs out
+        while True:
+            try:
+                future, sub_url, params, rest_api = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.query_cluster(rest_api, sub_url, params))
+            except Exception as ex:
+                future.set_exception(ex)
+
+    def query(self, *sub_urls, params=None):
+        # Run the queries against all the clusters concurrently, each cluster on its own worker threads.
+        # params holds the query parameters of any of the queries, e.g. {"vms": {"include_vm_disk_config": "true"}}.
+        # Returns the merged results per query and the (cluster, query, error) of failed ones.
+        # The queries of a cluster which does not answer within the timeout are reported and left behind,
+        # their threads being daemons which do not hold up the exit.
+        results = {sub_url: [] for sub_url in sub_urls}
+        errors = []
+
+        cluster_futures = []
+        for rest_api in self.sessions:
+            work_queue = queue.Queue()
+            futures = {}
+            for sub_url in sub_urls:
+                future = Future()
+                futures[future] = sub_url
+                work_queue.put((future, sub_url, (params or {}).get(sub_url), rest_api))
+            deadline = time.monotonic() + self.timeout
+            for index in range(min(self.max_workers, len(sub_urls))):
+                threading.Thread(target=self.run_worker, args=(work_queue,), daemon=True).start()
+            cluster_futures.append((rest_api.cluster_ip_address, futures, deadline))
+
+        for cluster_ip_address, futures, deadline in cluster_futures:
+            done, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()))
+            for future, sub_url in futures.items():
+                if future in not_done:
+                    future.cancel()
+                    errors.append((cluster_ip_address, sub_url, "timed out"))
+                    continue
+                try:
+                    results[sub_url].extend(future.result())
+                except Exception as ex:
+                    errors.append((cluster_ip_address, sub_url, str(ex)))
+
+        return results, errors
+
+    def sweep(self):
+        # Inventory sweep of cluster info, containers, networks and VMs of all the clusters
+        return self.query(*SWEEP_QUERIES)
+
+
+def load_endpoints(file_name):
+    # Load [{"ip_address": ..., "username": ..., "password": ...}, ...]
+    with open(file_name, "rt") as fin:
+        clusters = json.load(fin)
+
+    return [(cluster["ip_address"], cluster["username"], cluster["password"]) for cluster in clusters]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query many NTNX clusters concurrently")
+    parser.add_argument("clusters", help="JSON file of cluster endpoints and credentials")
+    parser.add_argument("--query", choices=list(CLUSTER_QUERIES.keys()), action="append",
+                        help="query to run (default: the sweep queries)")
+    parser.add_argument("--workers", type=int, default=CLUSTER_WORKERS, help="queries run at once per cluster")
+    parser.add_argument("--timeout", type=float, default=FANOUT_TIMEOUT)
+    parser.add_argument("--metrics", help="write the REST API metrics to this file (.json or Prometheus text)")
+    args = parser.parse_args()
+
+    group = NtnxClusterGroup(load_endpoints(args.clusters), args.workers, args.timeout)
+    fanout_results, fanout_errors = group.query(*(args.query or SWEEP_QUERIES))
+
+    print("#" * 79)
+    for query_name, query_results in fanout_results.items():
+        per_cluster = {}
+        for query_result in query_results:
+            per_cluster[query_result[CLUSTER_TAG]] = per_cluster.get(query_result[CLUSTER_TAG], 0) + 1
+        print("{}: {} entities".format(query_name, len(query_results)))
+        for cluster_ip, num_results in sorted(per_cluster.items()):
+            print("  {}: {}".format(cluster_ip, num_results))
+    for cluster_ip, query_name, error in fanout_errors:
+        print("Failed {} on {}: {}".format(query_name, cluster_ip, error))
+
+    if args.metrics:
+        with open(args.metrics, "wt") as fout:
+            fout.write(group.metrics.to_json() if args.metrics.endswith(".json") else group.metrics.to_prometheus())
@@ -0,0 +1,207 @@
+############################################################
+#
+#  Script: Validate Nutanix VM specs locally before creating the VMs
+#  Author: Yukiya Shimizu
+#  Description: Check disk sizes against container free space and IPs against network pools
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import ipaddress
+from ntnx_cluster_bak2 import NtnxRestApiSession, NtnxEntityIndex, DISK_TYPE, DISK_SIZE_UNIT, GET
+
+# States of the addresses of a network
+OUTSIDE_POOL = 0
+FREE = 1
+USED = 2
+
+
+def get_free_bytes(container):
+    # Free space of a container, from its usage stats when Prism reports it
+    usage_stats = container.get("usage_stats") or {}
+    free_bytes = usage_stats.get("storage.user_unreserved_free_bytes")
+    if free_bytes is not None:
+        return int(free_bytes)
+    return int(container.get("max_capacity") or 0) - int(usage_stats.get("storage.usage_bytes") or 0)
+
+
+class NtnxIpPool:
+    def __init__(self, ip_config, used_addresses=()):
+        # A byte per address of the subnet telling whether it is outside the DHCP pool, free or used.
+        # Free pool addresses are handed out by a cursor which only moves forward, so in O(1) amortized.
+        self.network = ipaddress.ip_network("{}/{}".format(ip_config["network_address"],
+                                                           ip_config["prefix_length"]), strict=False)
+        self.first = int(self.network.network_address)
+        self.states = bytearray(self.network.num_addresses)
+        self.cursor = 0
+
+        for pool in ip_config.get("pool") or []:
+            first_address, last_address = pool["range"].split()
+            first = self.get_offset(first_address)
+            last = self.get_offset(last_address)
+            if first is not None and last is not None and first <= last:
+                self.states[first:last + 1] = bytes([FREE]) * (last - first + 1)
+
+        reserved = [self.network.network_address, self.network.broadcast_address,
+                    ip_config.get("default_gateway"), ip_config.get("dhcp_server_address")]
+        for address in reserved + list(used_addresses):
+            if address:
+                self.reserve(address)
+
+    def get_offset(self, address):
+        # Offset of the address in the subnet, None when it is not in the subnet
+        try:
+            offset = int(ipaddress.ip_address(address)) - self.first
+        except ValueError:
+            return None
+        if 0 <= offset < len(self.states):
+            return offset
+        return None
+
+    def check(self, address):
+        # Why the address cannot be requested, None if it can
+        offset = self.get_offset(address)
+        if offset is None:
+            return "{} is not in {}".format(address, self.network)
+        if self.states[offset] == USED:
+            return "{} is already in use".format(address)
+        return None
+
+    def reserve(self, address):
+        offset = self.get_offset(address)
+        if offset is not None:
+            self.states[offset] = USED
+
+    def allocate(self):
+        # A free pool address, reserved for the caller, or None when the pool is exhausted
+        offset = self.states.find(FREE, self.cursor)
+        if offset < 0:
+            return None
+        self.states[offset] = USED
+        self.cursor = offset + 1
+        return str(ipaddress.ip_address(self.first + offset))
+
+
+class NtnxPreflightValidator:
+    def __init__(self, ntnx_rest_api):
+        # Checks VM specs (as in ntnx_vm_batch) against the synced containers and networks.
+        # Disks and IPs of the validated specs are counted as taken for the specs after them.
+        self.rest_api = ntnx_rest_api
+        self.containers_index = NtnxEntityIndex("storage_containers")
+        self.networks_index = NtnxEntityIndex("networks")
+        self.free_bytes = {}
+        self.ip_pools = {}
+
+    def sync(self):
+        self.containers_index.sync(self.rest_api.get_entities("storage_containers"))
+        self.networks_index.sync(self.rest_api.get_entities("networks"))
+        self.free_bytes = {}
+        self.ip_pools = {}
+
+    def get_ip_pool(self, network):
+        # Pool of an IP-managed network with the addresses in use, None for an unmanaged one
+        if network.uuid not in self.ip_pools:
+            ip_config = network.ip_config or {}
+            if not ip_config.get("network_address"):
+                self.ip_pools[network.uuid] = None
+            else:
+                rest_status, response = self.rest_api.rest_call(GET, "networks/{}/addresses".format(network.uuid),
+                                                                None)
+                used_addresses = [address.get("ip_address") for address in response.get("entities") or []]
+                self.ip_pools[network.uuid] = NtnxIpPool(ip_config, used_addresses)
+        return self.ip_pools[network.uuid]
+
+    def check_disk(self, vm_disk_spec):
+        # Take the space of a disk from its container, returning why it cannot be, None if it can
+        device_bus = vm_disk_spec.get("device_bus", "SCSI")
+        if device_bus not in DISK_TYPE:
+            return "Disk type {} is not one of {}".format(device_bus, DISK_TYPE)
+        if device_bus == "IDE":
+            return None
+
+        try:
+            container = self.containers_index.get("name", vm_disk_spec.get("container"))
+        except (KeyError, ValueError) as ex:
+            return ex.args[0]
+        uuid = container.storage_container_uuid
+        if uuid not in self.free_bytes:
+            self.free_bytes[uuid] = get_free_bytes(container)
+
+        if not vm_disk_spec.get("size"):
+            return "Disk on {} has no size".format(container.name)
+        try:
+            size_bytes = int(vm_disk_spec["size"]) * DISK_SIZE_UNIT
+        except (TypeError, ValueError):
+            return "Disk size {} is not a number of MB".format(vm_disk_spec["size"])
+        if size_bytes <= 0:
+            return "Disk size {} is not positive".format(vm_disk_spec.get("size"))
+        if size_bytes > self.free_bytes[uuid]:
+            return "Disk of {} MB does not fit in the {} MB left on {}".format(
+                size_bytes // DISK_SIZE_UNIT, self.free_bytes[uuid] // DISK_SIZE_UNIT, container.name)
+        self.free_bytes[uuid] -= size_bytes
+        return None
+
+    def check_nic(self, vm_nic_spec, allocate_ips=False):
+        # Reserve the requested IP of a NIC, or a free one with allocate_ips,
+        # returning why it cannot be, None if it can
+        try:
+            network = self.networks_index.get("name", vm_nic_spec.get("network"))
+        except (KeyError, ValueError) as ex:
+            return ex.args[0]
+
+        ip_pool = self.get_ip_pool(network)
+        requested_ip_address = vm_nic_spec.get("requested_ip_address")
+        if ip_pool is None:
+            if requested_ip_address:
+                return "Network {} does not manage IP addresses".format(network.name)
+            return None
+
+        if not requested_ip_address:
+            if allocate_ips:
+                requested_ip_address = ip_pool.allocate()
+                if requested_ip_address is None:
+                    return "No free IP address left in the pool of {}".format(network.name)
+                vm_nic_spec["requested_ip_address"] = requested_ip_address
+            return None
+
+        error = ip_pool.check(requested_ip_address)
+        if error:
+            return "{} on {}".format(error, network.name)
+        ip_pool.reserve(requested_ip_address)
+        return None
+
+    def validate(self, vm_specs, allocate_ips=False):
+        # Errors of every VM spec in order, an empty list for a valid one.
+        # With allocate_ips, NICs on IP-managed networks without a requested IP get a free one.
+        errors = []
+        for vm_spec in vm_specs:
+            vm_errors = [self.check_disk(vm_disk_spec) for vm_disk_spec in vm_spec.get("disks", [])]
+            vm_errors += [self.check_nic(vm_nic_spec, allocate_ips) for vm_nic_spec in vm_spec.get("nics", [])]
+            errors.append([error for error in vm_errors if error])
+        return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate NTNX VM specs against a cluster without creating them")
+    parser.add_argument("spec", help="JSON or CSV file of VM definitions")
+    parser.add_argument("cluster_ip", help="Cluster Virtual IP Address")
+    parser.add_argument("username")
+    parser.add_argument("--allocate-ips", action="store_true", help="show the IPs allocated to NICs without one")
+    args = parser.parse_args()
+
+    from ntnx_vm_batch import load_vm_specs
+    password = input("Please enter password for the username\n")
+    validator = NtnxPreflightValidator(NtnxRestApiSession(args.cluster_ip, args.username, password))
+    validator.sync()
+    vm_specs = load_vm_specs(args.spec)
+    validation_errors = validator.validate(vm_specs, args.allocate_ips)
+
+    print("#" * 79)
+    for vm_spec, vm_errors in zip(vm_specs, validation_errors):
+        print("{}: {}".format(vm_spec.get("name"), "; ".join(vm_errors) if vm_errors else "OK"))
+        if args.allocate_ips:
+            for vm_nic_spec in vm_spec.get("nics", []):
+                print("  {}: {}".format(vm_nic_spec.get("network"), vm_nic_spec.get("requested_ip_address")))
+    print("{} of {} VM specs are valid".format(
+        sum(1 for vm_errors in validation_errors if not vm_errors), len(vm_specs)))
@@ -0,0 +1,248 @@
+############################################################
+#
+#  Script: Reconcile Nutanix Clusters with a desired state via REST API (v2)
+#  Author: Yukiya Shimizu
+#  Description: Plan and apply the creates/updates of containers, networks and VMs
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ntnx_cluster_bak2 import NtnxRestApiSession, NtnxEntityIndex, ENTITY_MODELS, POST, PUT
+from ntnx_vm_batch import NtnxVmBatch
+from ntnx_tasks import NtnxTaskTracker, task_succeeded
+
+RECONCILE_WORKERS = 8
+# Collections in the order they are planned, VMs referring to the containers and networks
+RECONCILED_KINDS = ["storage_containers", "networks", "vms"]
+# Fields of an existing VM updated in place, disks and NICs are only set when the VM is created
+VM_UPDATE_FIELDS = ["num_vcpus", "num_cores_per_vcpu", "memory_mb"]
+CREATE = "create"
+UPDATE = "update"
+
+
+def is_subset(desired, current):
+    # Whether the current value already has everything of the desired one.
+    # Fields the cluster adds to dicts (e.g. usage_stats) are not differences.
+    if isinstance(desired, dict):
+        return isinstance(current, dict) and all(is_subset(value, current.get(key))
+                                                 for key, value in desired.items())
+    if isinstance(desired, list):
+        return isinstance(current, list) and len(desired) == len(current) and \
+            all(is_subset(value, current_value) for value, current_value in zip(desired, current))
+    return desired == current
+
+
+def load_desired_state(file_name):
+    # Load [{"ip_address": ..., "username": ..., "password": ...,
+    #        "storage_containers": [...], "networks": [...], "vms": [...]}, ...]
+    # VMs are defined as in ntnx_vm_batch, referring to containers and networks by name
+    with open(file_name, "rt") as fin:
+        return json.load(fin)
+
+
+class NtnxPlanStep:
+    def __init__(self, cluster_state, action, kind, name, payload, uuid=None, depends_on=()):
+        # A create or update of one entity, run once the steps it depends on have succeeded
+        self.cluster_state = cluster_state
+        self.action = action
+        self.kind = kind
+        self.name = name
+        self.payload = payload
+        self.uuid = uuid
+        self.depends_on = list(depends_on)
+        self.status = "PENDING"
+        self.error = None
+
+    def __str__(self):
+        return "{} {} {} {}{}".format(self.cluster_state.rest_api.cluster_ip_address, self.action, self.kind,
+                                      self.name, " ({})".format(self.uuid) if self.uuid else "")
+
+
+class NtnxClusterState:
+    def __init__(self, ntnx_rest_api, task_tracker=None):
+        # Entities of a cluster indexed by name for the diff, and a VM batch resolving the names in VM specs
+        self.rest_api = ntnx_rest_api
+        self.task_tracker = task_tracker
+        self.indexes = {kind: NtnxEntityIndex(kind) for kind in RECONCILED_KINDS}
+        self.vm_batch = NtnxVmBatch(ntnx_rest_api, task_tracker=task_tracker)
+        self.vm_batch_indexes = {"storage_containers": self.vm_batch.containers_index,
+                                 "networks": self.vm_batch.networks_index}
+        self.lock = threading.Lock()
+
+    def sync(self):
+        for kind in RECONCILED_KINDS:
+            self.sync_collection(kind)
+
+    def sync_collection(self, kind):
+        # Entities are kept whole to diff any field of the desired state.
+        # Unchanged pages are revalidated with a conditional GET.
+        entities = list(self.rest_api.iter_entities(kind, conditional=True))
+        with self.lock:
+            self.indexes[kind].sync(entities)
+            if kind in self.vm_batch_indexes:
+                model = ENTITY_MODELS[kind]
+                self.vm_batch_indexes[kind].sync([model(entity, self.rest_api) for entity in entities])
+
+    def get_current(self, kind, name):
+        # The entity with the name, None if there is none
+        entities = self.indexes[kind].find("name", name)
+        if len(entities) > 1:
+            raise ValueError("{} name {} is not unique on {}".format(kind, name, self.rest_api.cluster_ip_address))
+        return entities[0] if entities else None
+
+    def plan(self, desired):
+        # Diff the desired containers, networks and VMs of the cluster against its entities
+        steps = []
+        creates = {}
+        for kind in ("storage_containers", "networks"):
+            for spec in desired.get(kind, []):
+                current = self.get_current(kind, spec["name"])
+                if current is None:
+                    step = NtnxPlanStep(self, CREATE, kind, spec["name"], spec)
+                    creates[(kind, spec["name"])] = step
+                    steps.append(step)
+                elif not is_subset(spec, current):
+                    uuid = current.get(self.indexes[kind].uuid_key)
+                    steps.append(NtnxPlanStep(self, UPDATE, kind, spec["name"], dict(current, **spec), uuid))
+
+        for vm_spec in desired.get("vms", []):
+            current = self.get_current("vms", vm_spec["name"])
+            if current is None:
+                # A new VM waits for the containers and networks it refers to, when they are created too
+                references = [("storage_containers", disk["container"]) for disk in vm_spec.get("disks", [])
+                              if disk.get("container")]
+                references += [("networks", nic["network"]) for nic in vm_spec.get("nics", [])]
+                depends_on = [creates[reference] for reference in references if reference in creates]
+                steps.append(NtnxPlanStep(self, CREATE, "vms", vm_spec["name"], vm_spec, depends_on=depends_on))
+                continue
+
+            changes = {field: int(vm_spec[field]) for field in VM_UPDATE_FIELDS
+                       if field in vm_spec and int(vm_spec[field]) != current.get(field)}
+            if changes:
+                steps.append(NtnxPlanStep(self, UPDATE, "vms", vm_spec["name"], dict(changes, name=vm_spec["name"]),
+                                          current.get("uuid")))
+        return steps
+
+    def check_response(self, rest_status, response):
+        if rest_status not in (200, 201):
+            raise Exception("HTTP {}: {}".format(rest_status, response.get("message", response)))
+
+    def wait_task(self, response):
+        # Wait for the task of a VM operation when tracking tasks
+        if self.task_tracker is None:
+            return "SUBMITTED"
+        task = self.task_tracker.track(response.get("task_uuid")).result()
+        if not task_succeeded(task):
+            raise Exception((task.get("meta_response") or {}).get("error_detail") or task.get("progress_status"))
+        return "SUCCEEDED"
+
+    def apply(self, step):
+        # Run a plan step and return its status
+        if step.kind == "vms":
+            if step.action == CREATE:
+                with self.lock:
+                    vm_config_dto = self.vm_batch.build_vm_config_dto(step.payload)
+                rest_status, response = self.rest_api.rest_call(POST, "vms", json.dumps(vm_config_dto))
+            else:
+                rest_status, response = self.rest_api.rest_call(PUT, "vms/{}".format(step.uuid),
+                                                                json.dumps(step.payload))
+            self.check_response(rest_status, response)
+            return self.wait_task(response)
+
+        if step.action == CREATE:
+            rest_status, response = self.rest_api.rest_call(POST, step.kind, json.dumps(step.payload))
+        elif step.kind == "networks":
+            rest_status, response = self.rest_api.rest_call(PUT, "networks/{}".format(step.uuid),
+                                                            json.dumps(step.payload))
+        else:
+            rest_status, response = self.rest_api.rest_call(PUT, step.kind, json.dumps(step.payload))
+        self.check_response(rest_status, response)
+
+        if step.action == CREATE:
+            # Pick up the UUID of the new entity for the VMs which refer to it
+            self.sync_collection(step.kind)
+        return "SUCCEEDED"
+
+
+class NtnxReconciler:
+    def __init__(self, clusters, max_workers=RECONCILE_WORKERS, wait_tasks=False):
+        # clusters is a list of (NtnxRestApiSession, desired state of the cluster)
+        self.clusters = [(NtnxClusterState(rest_api, NtnxTaskTracker(rest_api) if wait_tasks else None), desired)
+                         for rest_api, desired in clusters]
+        self.max_workers = max_workers
+
+    def plan(self):
+        # Sync all the clusters concurrently and return the steps bringing them to the desired state
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for future in [executor.submit(cluster_state.sync) for cluster_state, desired in self.clusters]:
+                future.result()
+
+        steps = []
+        for cluster_state, desired in self.clusters:
+            steps.extend(cluster_state.plan(desired))
+        return steps
+
+    def execute(self, steps):
+        # Run the steps as a DAG, each as soon as its dependencies have succeeded.
+        # The dependents of a failed step are skipped.
+        pending = list(steps)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for step in list(pending):
+                    if any(dependency.status in ("FAILED", "SKIPPED") for dependency in step.depends_on):
+                        step.status = "SKIPPED"
+                        step.error = "Dependency failed"
+                        pending.remove(step)
+                    elif all(dependency.status in ("SUCCEEDED", "SUBMITTED") for dependency in step.depends_on):
+                        step.status = "RUNNING"
+                        running[executor.submit(step.cluster_state.apply, step)] = step
+                        pending.remove(step)
+
+                if not running:
+                    continue
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        step.status = future.result()
+                    except Exception as ex:
+                        step.status = "FAILED"
+                        step.error = str(ex)
+        return steps
+
+    def apply(self, dry_run=False):
+        # Plan and, unless a dry run, execute the plan. Without changes only the read calls are made.
+        steps = self.plan()
+        if dry_run:
+            return steps
+        return self.execute(steps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile NTNX clusters with a desired state")
+    parser.add_argument("desired_state", help="JSON file of the clusters, their credentials and desired entities")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan without applying it")
+    parser.add_argument("--wait", action="store_true", help="wait for the VM tasks to complete")
+    parser.add_argument("--workers", type=int, default=RECONCILE_WORKERS)
+    args = parser.parse_args()
+
+    reconciler = NtnxReconciler([(NtnxRestApiSession(cluster["ip_address"], cluster["username"], cluster["password"],
+                                                     pool_maxsize=args.workers + 1), cluster)
+                                 for cluster in load_desired_state(args.desired_state)],
+                                args.workers, args.wait)
+    plan_steps = reconciler.apply(args.dry_run)
+
+    print("#" * 79)
+    for plan_step in plan_steps:
+        if args.dry_run:
+            print(plan_step)
+            continue
+        print("{}: {}{}".format(plan_step, plan_step.status,
+                                " " + plan_step.error if plan_step.error else ""))
+    if not plan_steps:
+        print("Clusters are in the desired state")
@@ -0,0 +1,199 @@
+############################################################
+#
+#  Script: Collect Nutanix performance statistics via REST API (v3)
+#  Author: Yukiya Shimizu
+#  Description: Pull time series stats of many entities into columnar arrays
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from ntnx_cluster_bak2 import NtnxRestApiSession, GET, POST
+
+STATS_WORKERS = 8
+# Entities whose time series are asked for in a single groups query
+STATS_BATCH_SIZE = 100
+STATS_DIR = os.path.join("data", "stats")
+# Metrics collected for each kind of entity by default
+STATS_METRICS = {
+    "cluster": ["hypervisor_cpu_usage_ppm", "hypervisor_memory_usage_ppm", "controller_num_iops",
+                "controller_avg_io_latency_usecs"],
+    "containers": ["controller_num_iops", "controller_avg_io_latency_usecs", "controller_io_bandwidth_kBps"],
+    "vms": ["hypervisor_cpu_usage_ppm", "memory_usage_ppm", "controller_num_iops",
+            "controller_avg_io_latency_usecs"],
+}
+# v3 groups entity type of each kind of entity
+STATS_ENTITY_TYPES = {"cluster": "cluster", "containers": "storage_container", "vms": "mh_vm"}
+# Seconds between the samples, Prism averages the raw samples into them
+STATS_INTERVAL = 300
+# Value of the samples Prism returned nothing for
+MISSING_VALUE = -1
+
+
+class NtnxStatsTable:
+    def __init__(self, stats_dir, kind, entity_ids, entity_names, metrics, start_time, interval, num_samples,
+                 mode="w+"):
+        # A memory-mapped (entities x samples) int64 array per metric in stats_dir, described by <kind>.json.
+        # Responses are written into their rows as they arrive, so nothing is accumulated in memory.
+        self.stats_dir = stats_dir
+        self.kind = kind
+        self.entity_ids = list(entity_ids)
+        self.entity_names = list(entity_names)
+        self.metrics = list(metrics)
+        self.start_time = start_time
+        self.interval = interval
+        self.num_samples = num_samples
+
+        os.makedirs(stats_dir, exist_ok=True)
+        shape = (max(len(self.entity_ids), 1), max(num_samples, 1))
+        self.columns = {metric: np.memmap(self.get_column_file(metric), dtype=np.int64, mode=mode, shape=shape)
+                        for metric in self.metrics}
+        if mode == "w+":
+            for column in self.columns.values():
+                column[:] = MISSING_VALUE
+            with open(os.path.join(stats_dir, kind + ".json"), "wt") as fout:
+                json.dump({"entity_ids": self.entity_ids, "entity_names": self.entity_names, "metrics": self.metrics,
+                           "start_time": start_time, "interval": interval, "num_samples": num_samples}, fout)
+
+    def get_column_file(self, metric):
+        return os.path.join(self.stats_dir, "{}.{}.i8".format(self.kind, metric))
+
+    def put(self, row, metric, times, values):
+        # Write the samples of a metric of an entity taken at times (seconds), leaving out those outside the window
+        column = self.columns.get(metric)
+        if column is None or not len(values):
+            return
+        samples = np.rint((np.asarray(times, dtype=np.float64) - self.start_time) / self.interval).astype(np.int64)
+        in_window = (samples >= 0) & (samples < self.num_samples)
+        column[row, samples[in_window]] = np.asarray(values, dtype=np.int64)[in_window]
+
+    def get_timestamps(self):
+        return self.start_time + self.interval * np.arange(self.num_samples, dtype=np.int64)
+
+    def flush(self):
+        for column in self.columns.values():
+            column.flush()
+
+    def save_npz(self, file_name):
+        # Bundle the table into one compressed .npz with a column per metric
+        np.savez_compressed(file_name, entity_ids=np.array(self.entity_ids), entity_names=np.array(self.entity_names),
+                            timestamps=self.get_timestamps(), **self.columns)
+
+
+def open_stats_table(stats_dir, kind):
+    # Open a table written by a collection read-only, without loading the columns into memory
+    with open(os.path.join(stats_dir, kind + ".json"), "rt") as fin:
+        description = json.load(fin)
+    return NtnxStatsTable(stats_dir, kind, description["entity_ids"], description["entity_names"],
+                          description["metrics"], description["start_time"], description["interval"],
+                          description["num_samples"], mode="r")
+
+
+class NtnxStatsCollector:
+    def __init__(self, ntnx_rest_api, max_workers=STATS_WORKERS, batch_size=STATS_BATCH_SIZE):
+        # A v3 groups query serves the time series of all the metrics of many entities at once,
+        # so entities are asked for in batches and the batches are fetched concurrently
+        self.rest_api = ntnx_rest_api
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+
+    def get_entity_ids(self, kind):
+        # (UUID, name) of each entity of the kind
+        if kind == "cluster":
+            rest_status, cluster = self.rest_api.rest_call(GET, "cluster", None)
+            if rest_status != 200:
+                raise Exception("HTTP {}: {}".format(rest_status, cluster.get("message", cluster)))
+            return [(cluster.get("uuid"), cluster.get("name"))]
+        elif kind == "containers":
+            return [(container.storage_container_uuid, container.name)
+                    for container in self.rest_api.get_entities("storage_containers")]
+        return [(vm.uuid, vm.name) for vm in self.rest_api.get_entities("vms")]
+
+    def fetch(self, kind, entity_ids, metrics, start_time, end_time, interval):
+        # Time series of the metrics of the entities, as the entity_results of a groups query
+        groups_query = {
+            "entity_type": STATS_ENTITY_TYPES[kind],
+            "entity_ids": list(entity_ids),
+            "group_member_count": len(entity_ids),
+            "group_member_attributes": [{"attribute": metric} for metric in metrics],
+            "interval_start_ms": start_time * 1000,
+            "interval_end_ms": end_time * 1000,
+            "downsampling_interval": interval,
+        }
+        rest_status, response = self.rest_api.rest_call(POST, "groups", json.dumps(groups_query),
+                                                        base_url=self.rest_api.v3_url)
+        if rest_status != 200:
+            raise Exception("HTTP {}: {}".format(rest_status, response.get("message", response)))
+        return [entity_result for group_result in response.get("group_results") or []
+                for entity_result in group_result.get("entity_results") or []]
+
+    def fetch_into(self, table, rows, kind, entity_ids, end_time):
+        # Write the time series of a batch of entities into their rows
+        for entity_result in self.fetch(kind, entity_ids, table.metrics, table.start_time, end_time,
+                                        table.interval):
+            row = rows.get(entity_result.get("entity_id"))
+            if row is None:
+                continue
+            for metric_data in entity_result.get("data") or []:
+                samples = [sample for sample in metric_data.get("values") or [] if sample.get("values")]
+                table.put(row, metric_data.get("name"), [sample["time"] // 10 ** 6 for sample in samples],
+                          [int(float(sample["values"][0])) for sample in samples])
+
+    def collect(self, kind, start_time, end_time, interval=STATS_INTERVAL, metrics=None, stats_dir=STATS_DIR):
+        # Collect the time window [start_time, end_time) (seconds) of every entity of the kind into a table.
+        # Returns the table and the (entity, error) of failed entities.
+        entity_ids = self.get_entity_ids(kind)
+        num_samples = (end_time - start_time) // interval
+        table = NtnxStatsTable(stats_dir, kind, [entity_id for entity_id, name in entity_ids],
+                               [name for entity_id, name in entity_ids], metrics or STATS_METRICS[kind],
+                               start_time, interval, num_samples)
+        rows = {entity_id: row for row, entity_id in enumerate(table.entity_ids)}
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            batches = [table.entity_ids[first:first + self.batch_size]
+                       for first in range(0, len(table.entity_ids), self.batch_size)]
+            futures = [(batch, executor.submit(self.fetch_into, table, rows, kind, batch, end_time))
+                       for batch in batches]
+            for batch, future in futures:
+                try:
+                    future.result()
+                except Exception as ex:
+                    errors.extend((entity_id, str(ex)) for entity_id in batch)
+
+        table.flush()
+        return table, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect time series stats of NTNX entities")
+    parser.add_argument("cluster_ip", help="Cluster Virtual IP Address")
+    parser.add_argument("username")
+    parser.add_argument("kind", choices=list(STATS_METRICS.keys()))
+    parser.add_argument("--hours", type=float, default=24, help="length of the time window up to now")
+    parser.add_argument("--interval", type=int, default=STATS_INTERVAL, help="seconds between samples")
+    parser.add_argument("--metric", action="append", help="metric to collect (default: the kind's defaults)")
+    parser.add_argument("--workers", type=int, default=STATS_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=STATS_BATCH_SIZE, help="entities per stats query")
+    parser.add_argument("--dir", default=STATS_DIR, help="directory of the memory-mapped columns")
+    parser.add_argument("--npz", help="also bundle the columns into this .npz file")
+    args = parser.parse_args()
+
+    password = input("Please enter password for the username\n")
+    rest_api = NtnxRestApiSession(args.cluster_ip, args.username, password, pool_maxsize=args.workers + 1)
+    window_end = int(time.time()) // args.interval * args.interval
+    stats_table, stats_errors = NtnxStatsCollector(rest_api, args.workers, args.batch_size).collect(
+        args.kind, window_end - int(args.hours * 3600), window_end, args.interval, args.metric, args.dir)
+
+    print("#" * 79)
+    print("{} {} x {} samples of {}".format(len(stats_table.entity_ids), args.kind, stats_table.num_samples,
+                                            ", ".join(stats_table.metrics)))
+    for failed_id, error in stats_errors:
+        print("Failed {}: {}".format(failed_id, error))
+    if args.npz:
+        stats_table.save_npz(args.npz)
@@ -0,0 +1,125 @@
+############################################################
+#
+#  Script: Track Nutanix tasks via REST API (v2)
+#  Author: Yukiya Shimizu
+#  Description: Wait on many tasks per round trip with tasks/poll
+#  Language: Python3
+#
+############################################################
+
+import json
+import threading
+from concurrent.futures import Future, wait
+from ntnx_cluster_bak2 import POST
+
+POLL_BATCH_SIZE = 100
+# Seconds Prism holds a tasks/poll call open waiting for a completion
+POLL_TIMEOUT = 10
+POLL_MIN_INTERVAL = 0.5
+POLL_MAX_INTERVAL = 30
+SUCCEEDED = "Succeeded"
+
+
+def task_succeeded(task):
+    # Whether a completed TaskDTO finished successfully
+    return task.get("progress_status") == SUCCEEDED
+
+
+def task_entity_uuids(task, entity_type=None):
+    # UUIDs of the entities (e.g. the created VM) a completed TaskDTO worked on
+    return [entity.get("entity_id") for entity in task.get("entity_list") or []
+            if entity_type is None or entity.get("entity_type") == entity_type]
+
+
+class NtnxTaskTracker:
+    def __init__(self, ntnx_rest_api, batch_size=POLL_BATCH_SIZE, poll_timeout=POLL_TIMEOUT,
+                 min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+        self.rest_api = ntnx_rest_api
+        self.batch_size = batch_size
+        self.poll_timeout = poll_timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.poller = None
+        self.closed = False
+
+    def track(self, task_uuid, callback=None):
+        # Start tracking a task and return a Future resolved with its TaskDTO once completed.
+        # The callback, if any, is called with the Future.
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Task tracker is closed")
+
+            future = self.pending.get(task_uuid)
+            if future is None:
+                future = Future()
+                self.pending[task_uuid] = future
+            if callback:
+                future.add_done_callback(callback)
+
+            if self.poller is None or not self.poller.is_alive():
+                self.poller = threading.Thread(target=self.poll_loop, daemon=True)
+                self.poller.start()
+        return future
+
+    def poll(self, task_uuids):
+        # Wait on many tasks with a single tasks/poll call and return the completed TaskDTOs
+        payload = {"completed_tasks": task_uuids, "timeout_interval": self.poll_timeout}
+        rest_status, response = self.rest_api.rest_call(POST, "tasks/poll", json.dumps(payload))
+        if rest_status not in (200, 201):
+            raise Exception("HTTP {}: {}".format(rest_status, response))
+
+        return response.get("completed_tasks_info") or []
+
+    def poll_loop(self):
+        # Poll pending tasks in batches until none are left, backing off while nothing completes
+        while True:
+            with self.condition:
+                if not self.pending or self.closed:
+                    self.poller = None
+                    return
+                task_uuids = list(self.pending.keys())
+
+            num_completed = 0
+            for i in range(0, len(task_uuids), self.batch_size):
+                try:
+                    completed_tasks = self.poll(task_uuids[i:i + self.batch_size])
+                except Exception as ex:
+                    print("Polling tasks failed: {}".format(ex))
+                    completed_tasks = []
+
+                for task in completed_tasks:
+                    with self.condition:
+                        future = self.pending.pop(task.get("uuid"), None)
+                    if future is not None:
+                        num_completed += 1
+                        future.set_result(task)
+
+            # Poll again right away while tasks keep completing, slow down while they do not
+            if num_completed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed, timeout=self.interval)
+
+    def wait_all(self, timeout=None):
+        # Wait for all the tracked tasks and return the futures not completed in time
+        with self.condition:
+            futures = list(self.pending.values())
+        done, not_done = wait(futures, timeout=timeout)
+        return not_done
+
+    def close(self):
+        # Stop polling and fail the tasks still pending
+        with self.condition:
+            self.closed = True
+            pending = self.pending
+            self.pending = {}
+            self.condition.notify_all()
+
+        for future in pending.values():
+            future.set_exception(RuntimeError("Task tracker closed before the task completed"))
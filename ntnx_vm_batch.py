@@ -0,0 +1,199 @@
+############################################################
+#
+#  Script: Create Nutanix VMs in batch via REST API (v2)
+#  Author: Yukiya Shimizu
+#  Description: Create VMs from a JSON/CSV spec file without prompts
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+from ntnx_cluster_bak2 import NtnxRestApiSession, NtnxEntityIndex, POST, DISK_TYPE, \
+    build_vm_disk_dto, build_vm_nic_spec_dto, build_vm_config_dto
+from ntnx_tasks import NtnxTaskTracker, task_succeeded, task_entity_uuids
+from ntnx_preflight import NtnxPreflightValidator
+
+BATCH_WORKERS = 8
+
+
+def parse_csv_vm_spec(row):
+    # A CSV row has name,num_vcpus,num_cores_per_vcpu,memory_mb,disks,nics where
+    # disks is "SCSI:<container>:<size>;IDE;..." and nics is "<network>[:<ip address>];..."
+    vm_spec = {
+        "name": row["name"],
+        "num_vcpus": row["num_vcpus"],
+        "num_cores_per_vcpu": row.get("num_cores_per_vcpu") or 1,
+        "memory_mb": row["memory_mb"],
+        "disks": [],
+        "nics": [],
+    }
+
+    for disk in filter(None, (row.get("disks") or "").split(";")):
+        disk_fields = disk.split(":")
+        vm_disk_spec = {"device_bus": disk_fields[0]}
+        # A disk without its container or size is left so, to be rejected as an invalid spec
+        if len(disk_fields) > 1:
+            vm_disk_spec["container"] = disk_fields[1]
+        if len(disk_fields) > 2:
+            vm_disk_spec["size"] = disk_fields[2]
+        vm_spec["disks"].append(vm_disk_spec)
+
+    for nic in filter(None, (row.get("nics") or "").split(";")):
+        nic_fields = nic.split(":")
+        vm_nic_spec = {"network": nic_fields[0]}
+        if len(nic_fields) > 1:
+            vm_nic_spec["requested_ip_address"] = nic_fields[1]
+        vm_spec["nics"].append(vm_nic_spec)
+
+    return vm_spec
+
+
+def load_vm_specs(file_name):
+    # Load VM definitions from a JSON list or a CSV file
+    if file_name.lower().endswith(".csv"):
+        with open(file_name, "rt", newline="") as fin:
+            return [parse_csv_vm_spec(row) for row in csv.DictReader(fin)]
+
+    with open(file_name, "rt") as fin:
+        return json.load(fin)
+
+
+class NtnxVmBatch:
+    def __init__(self, ntnx_rest_api, max_workers=BATCH_WORKERS, task_tracker=None, validator=None,
+                 allocate_ips=False):
+        # With a task tracker, VM creation tasks are tracked while further VMs are submitted.
+        # With a validator, VM specs which would fail on the cluster are rejected before any is submitted.
+        self.rest_api = ntnx_rest_api
+        self.max_workers = max_workers
+        self.task_tracker = task_tracker
+        self.validator = validator
+        self.allocate_ips = allocate_ips
+        self.containers_index = NtnxEntityIndex("storage_containers")
+        self.networks_index = NtnxEntityIndex("networks")
+
+    def sync_indexes(self):
+        # Resolve container and network names against a single sync of each collection
+        self.containers_index.sync(self.rest_api.get_entities("storage_containers"))
+        self.networks_index.sync(self.rest_api.get_entities("networks"))
+
+    def build_vm_config_dto(self, vm_spec):
+        # Build a VmConfigDTO from a VM definition, raising KeyError/ValueError on bad names
+        vm_disks = []
+        for vm_disk_spec in vm_spec.get("disks", []):
+            device_bus = vm_disk_spec.get("device_bus", "SCSI")
+            if device_bus not in DISK_TYPE:
+                raise ValueError("Disk type {} is not one of {}".format(device_bus, DISK_TYPE))
+            if device_bus == "IDE":
+                vm_disks.append(build_vm_disk_dto(device_bus))
+                continue
+
+            container = self.containers_index.get("name", vm_disk_spec["container"])
+            if not vm_disk_spec.get("size"):
+                raise ValueError("Disk on {} has no size".format(container.name))
+            vm_disks.append(build_vm_disk_dto(device_bus, container.storage_container_uuid,
+                                              int(vm_disk_spec["size"])))
+
+        vm_nics = []
+        for vm_nic_spec in vm_spec.get("nics", []):
+            network = self.networks_index.get("name", vm_nic_spec["network"])
+            vm_nics.append(build_vm_nic_spec_dto(network.uuid, vm_nic_spec.get("requested_ip_address")))
+
+        return build_vm_config_dto(vm_spec["name"], int(vm_spec["num_vcpus"]),
+                                   int(vm_spec.get("num_cores_per_vcpu", 1)), int(vm_spec["memory_mb"]),
+                                   vm_disks, vm_nics)
+
+    def create_vm(self, vm_config_dto):
+        # POST a VmConfigDTO and return the task UUID of the creation, and its Future when tracked
+        rest_status, response = self.rest_api.rest_call(POST, "vms", json.dumps(vm_config_dto))
+        if rest_status not in (200, 201):
+            raise Exception("HTTP {}: {}".format(rest_status, response.get("message", response)))
+
+        task_uuid = response.get("task_uuid")
+        if self.task_tracker:
+            return task_uuid, self.task_tracker.track(task_uuid)
+        return task_uuid, None
+
+    def run(self, vm_specs):
+        # Create all the VMs with bounded concurrency and return a result per VM definition
+        self.sync_indexes()
+        validation_errors = [[] for vm_spec in vm_specs]
+        if self.validator:
+            self.validator.sync()
+            validation_errors = self.validator.validate(vm_specs, self.allocate_ips)
+
+        results = []
+        vm_config_dtos = []
+        for vm_spec, vm_errors in zip(vm_specs, validation_errors):
+            result = {"name": vm_spec.get("name"), "status": "FAILED"}
+            results.append(result)
+            if vm_errors:
+                result["error"] = "Invalid spec: {}".format("; ".join(vm_errors))
+                continue
+            try:
+                vm_config_dtos.append((result, self.build_vm_config_dto(vm_spec)))
+            except (KeyError, ValueError, TypeError) as ex:
+                result["error"] = "Invalid spec: {}".format(ex)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [(result, executor.submit(self.create_vm, vm_config_dto))
+                       for result, vm_config_dto in vm_config_dtos]
+            task_futures = []
+            for result, future in futures:
+                try:
+                    result["task_uuid"], task_future = future.result()
+                    result["status"] = "SUBMITTED"
+                    if task_future:
+                        task_futures.append((result, task_future))
+                except Exception as ex:
+                    result["error"] = str(ex)
+
+        for result, task_future in task_futures:
+            try:
+                task = task_future.result()
+            except Exception as ex:
+                result["status"] = "FAILED"
+                result["error"] = str(ex)
+                continue
+            if task_succeeded(task):
+                result["status"] = "SUCCEEDED"
+                result["vm_uuid"] = next(iter(task_entity_uuids(task, "VM")), None)
+            else:
+                result["status"] = "FAILED"
+                result["error"] = (task.get("meta_response") or {}).get("error_detail") or task.get("progress_status")
+
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create NTNX VMs in batch from a spec file")
+    parser.add_argument("spec", help="JSON or CSV file of VM definitions")
+    parser.add_argument("cluster_ip", help="Cluster Virtual IP Address")
+    parser.add_argument("username")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--report", help="write the per-VM results to this JSON file")
+    parser.add_argument("--wait", action="store_true", help="wait for the VM creation tasks to complete")
+    parser.add_argument("--no-preflight", action="store_true", help="skip the local validation of the VM specs")
+    parser.add_argument("--allocate-ips", action="store_true",
+                        help="request a free pool IP for NICs on IP-managed networks without one")
+    args = parser.parse_args()
+
+    password = input("Please enter password for the username\n")
+    rest_api = NtnxRestApiSession(args.cluster_ip, args.username, password, pool_maxsize=args.workers + 1)
+    batch = NtnxVmBatch(rest_api, args.workers, NtnxTaskTracker(rest_api) if args.wait else None,
+                        None if args.no_preflight else NtnxPreflightValidator(rest_api), args.allocate_ips)
+    batch_results = batch.run(load_vm_specs(args.spec))
+
+    print("#" * 79)
+    for batch_result in batch_results:
+        print("{}: {} {}".format(batch_result["name"], batch_result["status"],
+                                 batch_result.get("task_uuid") or batch_result.get("error")))
+    print("{} of {} VMs {}".format(
+        sum(1 for batch_result in batch_results if batch_result["status"] in ("SUBMITTED", "SUCCEEDED")),
+        len(batch_results), "created" if args.wait else "submitted"))
+
+    if args.report:
+        with open(args.report, "wt") as fout:
+            json.dump(batch_results, fout, indent=2)
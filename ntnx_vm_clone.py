@@ -0,0 +1,166 @@
+############################################################
+#
+#  Script: Clone Nutanix VMs in bulk from a template via REST API (v2)
+#  Author: Yukiya Shimizu
+#  Description: Stamp out many VMs from a golden VM with bounded concurrency
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+from ntnx_cluster_bak2 import NtnxRestApiSession, NtnxEntityIndex, NtnxRateLimiter, POST
+from ntnx_tasks import NtnxTaskTracker, task_succeeded, task_entity_uuids
+
+CLONE_WORKERS = 8
+# Clone requests per second sent to a cluster
+CLONE_RATE = 5
+# Clones requested by a single clone call (spec_list), each call being one task on the cluster
+CLONE_BATCH_SIZE = 10
+
+
+def generate_names(name_pattern, count, start=1):
+    # Names of the clones from a pattern such as "vdi-{index:03d}", raising ValueError unless they are unique
+    names = [name_pattern.format(index=index) for index in range(start, start + count)]
+    if len(set(names)) < len(names):
+        raise ValueError("Name pattern {} does not give unique names, put {{index}} in it".format(name_pattern))
+    return names
+
+
+class NtnxVmCloner:
+    def __init__(self, ntnx_rest_api, max_workers=CLONE_WORKERS, rate=CLONE_RATE, batch_size=CLONE_BATCH_SIZE,
+                 task_tracker=None):
+        # The rate limit applies to the cluster of the session. With a task tracker,
+        # the clone tasks are tracked while further clones are requested.
+        self.rest_api = ntnx_rest_api
+        self.max_workers = max_workers
+        self.rate_limiter = NtnxRateLimiter(rate)
+        self.batch_size = batch_size
+        self.task_tracker = task_tracker
+        self.vms_index = NtnxEntityIndex("vms")
+
+    def resolve_source(self, source):
+        # UUID of the template VM given by its name or UUID
+        self.vms_index.sync(self.rest_api.get_entities("vms", use_cache=False))
+        if self.vms_index.get_by_uuid(source) is not None:
+            return source
+        return self.vms_index.get("name", source).uuid
+
+    def clone_vms(self, source_uuid, names, overrides):
+        # Request the clones of a batch with one call and return its task UUID, and its Future when tracked
+        spec_list = [dict(overrides, name=name) for name in names]
+        self.rate_limiter.acquire()
+        rest_status, response = self.rest_api.rest_call(POST, "vms/{}/clone".format(source_uuid),
+                                                        json.dumps({"spec_list": spec_list}))
+        if rest_status not in (200, 201):
+            raise Exception("HTTP {}: {}".format(rest_status, response.get("message", response)))
+
+        task_uuid = response.get("task_uuid")
+        if self.task_tracker:
+            return task_uuid, self.task_tracker.track(task_uuid)
+        return task_uuid, None
+
+    def run(self, source, names, overrides=None):
+        # Clone the source VM into all the names and return a result per name.
+        # Names already taken by a VM are skipped, so that a run can be repeated after a failure.
+        source_uuid = self.resolve_source(source)
+        overrides = overrides or {}
+
+        results = []
+        batches = []
+        for name in names:
+            result = {"name": name, "status": "FAILED"}
+            results.append(result)
+            if self.vms_index.find("name", name):
+                result["status"] = "EXISTS"
+                continue
+            if not batches or len(batches[-1]) == self.batch_size:
+                batches.append([])
+            batches[-1].append(result)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [(batch, executor.submit(self.clone_vms, source_uuid,
+                                               [result["name"] for result in batch], overrides))
+                       for batch in batches]
+            task_futures = []
+            for batch, future in futures:
+                try:
+                    task_uuid, task_future = future.result()
+                except Exception as ex:
+                    for result in batch:
+                        result["error"] = str(ex)
+                    continue
+                for result in batch:
+                    result["task_uuid"] = task_uuid
+                    result["status"] = "SUBMITTED"
+                if task_future:
+                    task_futures.append((batch, task_future))
+
+        for batch, task_future in task_futures:
+            try:
+                task = task_future.result()
+            except Exception as ex:
+                for result in batch:
+                    result["error"] = str(ex)
+                continue
+            if task_succeeded(task):
+                # The task does not tell which clone is which, only the UUIDs of the clones of the batch
+                vm_uuids = [vm_uuid for vm_uuid in task_entity_uuids(task, "VM") if vm_uuid != source_uuid]
+                for result in batch:
+                    result["status"] = "SUCCEEDED"
+                    result["batch_vm_uuids"] = vm_uuids
+            else:
+                for result in batch:
+                    result["status"] = "FAILED"
+                    result["error"] = (task.get("meta_response") or {}).get("error_detail") or \
+                        task.get("progress_status")
+
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clone NTNX VMs in bulk from a template VM")
+    parser.add_argument("cluster_ip", help="Cluster Virtual IP Address")
+    parser.add_argument("username")
+    parser.add_argument("source", help="name or UUID of the template VM")
+    parser.add_argument("name_pattern", help="names of the clones, e.g. vdi-{index:03d}")
+    parser.add_argument("count", type=int)
+    parser.add_argument("--start", type=int, default=1, help="index of the first clone")
+    parser.add_argument("--num-vcpus", type=int)
+    parser.add_argument("--memory-mb", type=int)
+    parser.add_argument("--workers", type=int, default=CLONE_WORKERS)
+    parser.add_argument("--rate", type=float, default=CLONE_RATE, help="clone requests per second")
+    parser.add_argument("--batch-size", type=int, default=CLONE_BATCH_SIZE, help="clones per clone request")
+    parser.add_argument("--report", help="write the per-VM results to this JSON file")
+    parser.add_argument("--wait", action="store_true", help="wait for the clone tasks to complete")
+    args = parser.parse_args()
+
+    clone_overrides = {}
+    if args.num_vcpus:
+        clone_overrides["num_vcpus"] = args.num_vcpus
+    if args.memory_mb:
+        clone_overrides["memory_mb"] = args.memory_mb
+
+    try:
+        clone_names = generate_names(args.name_pattern, args.count, args.start)
+    except (KeyError, IndexError, ValueError) as ex:
+        parser.error("Name pattern {} is wrong: {!r}".format(args.name_pattern, ex))
+
+    password = input("Please enter password for the username\n")
+    rest_api = NtnxRestApiSession(args.cluster_ip, args.username, password, pool_maxsize=args.workers + 1)
+    cloner = NtnxVmCloner(rest_api, args.workers, args.rate, args.batch_size,
+                          NtnxTaskTracker(rest_api) if args.wait else None)
+    clone_results = cloner.run(args.source, clone_names, clone_overrides)
+
+    print("#" * 79)
+    for clone_result in clone_results:
+        print("{}: {} {}".format(clone_result["name"], clone_result["status"],
+                                 clone_result.get("task_uuid") or clone_result.get("error") or ""))
+    print("{} of {} VMs {}".format(
+        sum(1 for clone_result in clone_results if clone_result["status"] in ("SUBMITTED", "SUCCEEDED")),
+        len(clone_results), "cloned" if args.wait else "submitted"))
+
+    if args.report:
+        with open(args.report, "wt") as fout:
+            json.dump(clone_results, fout, indent=2)
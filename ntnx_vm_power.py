@@ -0,0 +1,204 @@
+############################################################
+#
+#  Script: Change the power state of Nutanix VMs in bulk via REST API (v2)
+#  Author: Yukiya Shimizu
+#  Description: Power on/off many VMs in throttled waves per host
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ntnx_cluster_bak2 import NtnxRestApiSession, NtnxRateLimiter, VmsMenu, GET, POST
+from ntnx_tasks import NtnxTaskTracker, task_succeeded
+
+POWER_WORKERS = 8
+# set_power_state calls per second sent to a cluster
+POWER_RATE = 10
+# VMs of a host changed in the same wave, the next wave waits for the tasks of the current one
+WAVE_SIZE = 10
+# Seconds between waves, letting the VMs of a wave boot before the next one starts
+WAVE_INTERVAL = 0
+POWER_MAX_ATTEMPTS = 3
+# Power state a VM ends up in after a transition, VMs already in it are skipped
+TARGET_POWER_STATES = {"ON": "on", "OFF": "off", "ACPI_SHUTDOWN": "off"}
+TRANSITIONS = ["ON", "OFF", "ACPI_SHUTDOWN", "ACPI_REBOOT", "POWERCYCLE", "RESET", "PAUSE", "SUSPEND", "RESUME"]
+
+
+class NtnxVmPowerOperation:
+    def __init__(self, ntnx_rest_api, max_workers=POWER_WORKERS, rate=POWER_RATE, wave_size=WAVE_SIZE,
+                 wave_interval=WAVE_INTERVAL, max_attempts=POWER_MAX_ATTEMPTS, task_tracker=None):
+        # The rate limit applies to the cluster of the session. Without a task tracker,
+        # a wave is only submitted, not waited on, so several waves need a wave_interval between them.
+        self.rest_api = ntnx_rest_api
+        self.max_workers = max_workers
+        self.rate_limiter = NtnxRateLimiter(rate)
+        self.wave_size = wave_size
+        self.wave_interval = wave_interval
+        self.max_attempts = max_attempts
+        self.task_tracker = task_tracker
+
+    def select_vms(self, vm_uuids=None, power_state=None, name_pattern=None, host_uuid=None):
+        # VMs given by their UUIDs, or else matching all the given filters
+        if vm_uuids:
+            vm_uuids = set(vm_uuids)
+            return [vm for vm in self.rest_api.get_entities("vms", use_cache=False) if vm.uuid in vm_uuids]
+        return VmsMenu(self.rest_api).query_vms(power_state, name_pattern, host_uuid)
+
+    def get_waves(self, results):
+        # Split the VMs into waves of up to wave_size VMs of each host. VMs without a host (powered off)
+        # are grouped as if on one more host, so each wave has up to wave_size of them cluster-wide.
+        per_host = OrderedDict()
+        for result in results:
+            per_host.setdefault(result["host_uuid"], []).append(result)
+
+        waves = []
+        for host_results in per_host.values():
+            for wave_index, first in enumerate(range(0, len(host_results), self.wave_size)):
+                if wave_index == len(waves):
+                    waves.append([])
+                waves[wave_index].extend(host_results[first:first + self.wave_size])
+        return waves
+
+    def get_power_state(self, vm_uuid):
+        rest_status, response = self.rest_api.rest_call(GET, "vms/{}".format(vm_uuid), None)
+        if rest_status != 200:
+            return None
+        return str(response.get("power_state")).lower()
+
+    def set_power_state(self, vm_uuid, transition):
+        # Request a transition and return its task UUID, and its Future when tracked
+        self.rate_limiter.acquire()
+        rest_status, response = self.rest_api.rest_call(POST, "vms/{}/set_power_state".format(vm_uuid),
+                                                        json.dumps({"transition": transition}))
+        if rest_status not in (200, 201):
+            raise Exception("HTTP {}: {}".format(rest_status, response.get("message", response)))
+
+        task_uuid = response.get("task_uuid")
+        if self.task_tracker:
+            return task_uuid, self.task_tracker.track(task_uuid)
+        return task_uuid, None
+
+    def submit(self, vm_uuid, transition):
+        # Request a transition, retrying a failed request only when the VM did not reach the target state,
+        # as a request failing on the way back may still have been carried out.
+        # Returns (None, None) when the VM is found in the target state.
+        target = TARGET_POWER_STATES.get(transition)
+        for attempt in range(self.max_attempts):
+            try:
+                return self.set_power_state(vm_uuid, transition)
+            except Exception as ex:
+                error = ex
+            if attempt + 1 == self.max_attempts or target is None:
+                break
+            try:
+                if self.get_power_state(vm_uuid) == target:
+                    return None, None
+            except Exception:
+                pass
+        raise error
+
+    def run(self, vms, transition):
+        # Apply the transition to the VMs wave by wave and return a result per VM.
+        # Raises ValueError when there are several waves but nothing to hold a wave back from the next one.
+        target = TARGET_POWER_STATES.get(transition)
+        results = []
+        to_submit = []
+        for vm in vms:
+            result = {"name": vm.get("name"), "uuid": vm.get("uuid"), "host_uuid": vm.get("host_uuid"),
+                      "status": "FAILED"}
+            results.append(result)
+            if target and str(vm.get("power_state")).lower() == target:
+                result["status"] = "SKIPPED"
+            else:
+                to_submit.append(result)
+
+        waves = self.get_waves(to_submit)
+        if len(waves) > 1 and not self.task_tracker and not self.wave_interval:
+            raise ValueError("{} waves would all start at once, wait for the tasks of each wave "
+                             "or give an interval between waves".format(len(waves)))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for wave_index, wave in enumerate(waves):
+                if wave_index and self.wave_interval:
+                    time.sleep(self.wave_interval)
+                print("Wave {}: {} VMs".format(wave_index + 1, len(wave)))
+
+                futures = [(result, executor.submit(self.submit, result["uuid"], transition)) for result in wave]
+                task_futures = []
+                for result, future in futures:
+                    try:
+                        result["task_uuid"], task_future = future.result()
+                    except Exception as ex:
+                        result["error"] = str(ex)
+                        continue
+                    if result["task_uuid"] is None:
+                        result["status"] = "SKIPPED"
+                        continue
+                    result["status"] = "SUBMITTED"
+                    if task_future:
+                        task_futures.append((result, task_future))
+
+                for result, task_future in task_futures:
+                    try:
+                        task = task_future.result()
+                    except Exception as ex:
+                        result["status"] = "FAILED"
+                        result["error"] = str(ex)
+                        continue
+                    if task_succeeded(task):
+                        result["status"] = "SUCCEEDED"
+                    else:
+                        result["status"] = "FAILED"
+                        result["error"] = (task.get("meta_response") or {}).get("error_detail") or \
+                            task.get("progress_status")
+
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Change the power state of NTNX VMs in bulk")
+    parser.add_argument("cluster_ip", help="Cluster Virtual IP Address")
+    parser.add_argument("username")
+    parser.add_argument("transition", choices=TRANSITIONS)
+    parser.add_argument("--uuids", help="file of VM UUIDs, one per line, instead of the filters")
+    parser.add_argument("--power-state", help="select VMs in this power state")
+    parser.add_argument("--name", help="select VMs whose name matches this pattern, e.g. web-*")
+    parser.add_argument("--host", help="select VMs on this host UUID")
+    parser.add_argument("--workers", type=int, default=POWER_WORKERS)
+    parser.add_argument("--rate", type=float, default=POWER_RATE, help="set_power_state calls per second")
+    parser.add_argument("--wave-size", type=int, default=WAVE_SIZE, help="VMs per host in each wave")
+    parser.add_argument("--wave-interval", type=float, default=WAVE_INTERVAL, help="seconds between waves")
+    parser.add_argument("--report", help="write the per-VM results to this JSON file")
+    parser.add_argument("--wait", action="store_true", help="wait for the tasks of each wave to complete")
+    args = parser.parse_args()
+
+    selected_uuids = None
+    if args.uuids:
+        with open(args.uuids, "rt") as fin:
+            selected_uuids = [line.strip() for line in fin if line.strip()]
+
+    password = input("Please enter password for the username\n")
+    rest_api = NtnxRestApiSession(args.cluster_ip, args.username, password, pool_maxsize=args.workers + 1)
+    power_operation = NtnxVmPowerOperation(rest_api, args.workers, args.rate, args.wave_size, args.wave_interval,
+                                           task_tracker=NtnxTaskTracker(rest_api) if args.wait else None)
+    try:
+        power_results = power_operation.run(
+            power_operation.select_vms(selected_uuids, args.power_state, args.name, args.host), args.transition)
+    except ValueError as ex:
+        parser.error("{} (--wait or --wave-interval)".format(ex))
+
+    print("#" * 79)
+    for power_result in power_results:
+        print("{}: {} {}".format(power_result["name"], power_result["status"],
+                                 power_result.get("task_uuid") or power_result.get("error") or ""))
+    print("{} of {} VMs {}".format(
+        sum(1 for power_result in power_results if power_result["status"] in ("SUBMITTED", "SUCCEEDED")),
+        len(power_results), "changed" if args.wait else "submitted"))
+
+    if args.report:
+        with open(args.report, "wt") as fout:
+            json.dump(power_results, fout, indent=2)
@@ -0,0 +1,167 @@
+############################################################
+#
+#  Script: Watch Nutanix Cluster inventory via REST API (v2)
+#  Author: Yukiya Shimizu
+#  Description: Poll collections adaptively and emit change events
+#  Language: Python3
+#
+############################################################
+
+import argparse
+import heapq
+import json
+import os
+import threading
+import time
+from ntnx_cluster_bak2 import NtnxRestApiSession, NtnxEntityIndex, get_fingerprint, GET
+
+WATCH_EVENTS_FILE = os.path.join("data", "watch_events.jsonl")
+# Seconds between polls of each collection to start with
+WATCH_INTERVALS = {"cluster": 300, "storage_containers": 60, "networks": 120, "vms": 30}
+WATCH_MIN_INTERVAL = 5
+WATCH_MAX_INTERVAL = 600
+# A poll of a collection waits at least this many times the duration of the last poll,
+# so that a slow cluster is not kept busy by the watch
+LATENCY_FACTOR = 20
+# Factors the interval is multiplied by after a poll with and without changes
+CHURN_FACTOR = 0.5
+IDLE_FACTOR = 1.5
+
+
+class NtnxJsonlSink:
+    def __init__(self, file_name=WATCH_EVENTS_FILE):
+        # Append every event as a JSON line to the file
+        if os.path.dirname(file_name):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        self.fout = open(file_name, "at")
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, separators=(",", ":"))
+        with self.lock:
+            self.fout.write(line + "\n")
+            self.fout.flush()
+
+
+class NtnxWatcher:
+    def __init__(self, ntnx_rest_api, sinks, intervals=None, min_interval=WATCH_MIN_INTERVAL,
+                 max_interval=WATCH_MAX_INTERVAL):
+        # sinks are callables called with each event, e.g. an NtnxJsonlSink
+        self.rest_api = ntnx_rest_api
+        self.sinks = list(sinks)
+        self.intervals = dict(intervals or WATCH_INTERVALS)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.indexes = {collection: NtnxEntityIndex(collection) for collection in self.intervals
+                        if collection != "cluster"}
+        self.cluster_fingerprint = None
+        self.cluster = None
+        self.stop_event = threading.Event()
+
+    def emit(self, collection, event_type, entity, changed_fields=None):
+        uuid_key = self.indexes[collection].uuid_key if collection in self.indexes else "uuid"
+        event = {"time": time.time(), "cluster": self.rest_api.cluster_ip_address, "collection": collection,
+                 "event": event_type, "uuid": entity.get(uuid_key), "name": entity.get("name"), "entity": entity}
+        if changed_fields is not None:
+            event["changed_fields"] = changed_fields
+        for sink in self.sinks:
+            try:
+                sink(event)
+            except Exception as ex:
+                print("Sink failed: {}".format(ex))
+
+    def poll_cluster(self, initial):
+        rest_status, cluster = self.rest_api.rest_call(GET, "cluster", None)
+        if rest_status != 200:
+            raise Exception("HTTP {}: {}".format(rest_status, cluster.get("message", cluster)))
+
+        fingerprint = get_fingerprint(cluster)
+        if fingerprint == self.cluster_fingerprint:
+            return 0
+        # The previous state is missing when the initial poll failed
+        previous, self.cluster, self.cluster_fingerprint = self.cluster or {}, cluster, fingerprint
+        if initial:
+            return 0
+        self.emit("cluster", "modified", cluster, sorted(key for key in set(previous) | set(cluster)
+                                                         if previous.get(key) != cluster.get(key)))
+        return 1
+
+    def poll_collection(self, collection, initial):
+        # Sync a collection and emit its changes. Unchanged pages are revalidated with a conditional GET
+        # and hand back the same entity objects, which the index skips without fingerprinting them.
+        index = self.indexes[collection]
+        previous = dict(index.entities)
+        change_set = index.sync(list(self.rest_api.iter_entities(collection, conditional=True)))
+        if initial:
+            return 0
+
+        for entity in change_set.added:
+            self.emit(collection, "added", entity)
+        for entity in change_set.updated:
+            old_entity = previous.get(entity.get(index.uuid_key)) or {}
+            self.emit(collection, "modified", entity, sorted(key for key in set(old_entity) | set(entity)
+                                                             if old_entity.get(key) != entity.get(key)))
+        for entity in change_set.removed:
+            self.emit(collection, "removed", entity)
+        return len(change_set.added) + len(change_set.updated) + len(change_set.removed)
+
+    def poll(self, collection, initial=False):
+        # Poll a collection and return the seconds until its next poll
+        started_at = time.monotonic()
+        try:
+            if collection == "cluster":
+                num_changes = self.poll_cluster(initial)
+            else:
+                num_changes = self.poll_collection(collection, initial)
+        except Exception as ex:
+            print("Polling {} of {} failed: {}".format(collection, self.rest_api.cluster_ip_address, ex))
+            num_changes = 0
+        duration = time.monotonic() - started_at
+
+        # Follow a churning collection closely, back off from an idle one or a slow cluster
+        interval = self.intervals[collection] * (CHURN_FACTOR if num_changes else IDLE_FACTOR)
+        interval = max(self.min_interval, min(self.max_interval, interval), duration * LATENCY_FACTOR)
+        self.intervals[collection] = interval
+        return interval
+
+    def run(self):
+        # Take the initial state of every collection, then poll each one when its interval is due until stopped
+        schedule = []
+        for collection in self.intervals:
+            self.poll(collection, initial=True)
+            heapq.heappush(schedule, (time.monotonic() + self.intervals[collection], collection))
+
+        while not self.stop_event.is_set():
+            due_at, collection = heapq.heappop(schedule)
+            if self.stop_event.wait(max(0.0, due_at - time.monotonic())):
+                break
+            interval = self.poll(collection)
+            heapq.heappush(schedule, (time.monotonic() + interval, collection))
+
+    def start(self):
+        watcher = threading.Thread(target=self.run, daemon=True)
+        watcher.start()
+        return watcher
+
+    def stop(self):
+        self.stop_event.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch NTNX clusters and emit inventory change events")
+    parser.add_argument("clusters", help="JSON file of cluster endpoints and credentials")
+    parser.add_argument("--output", default=WATCH_EVENTS_FILE, help="JSONL file the events are appended to")
+    args = parser.parse_args()
+
+    from ntnx_multi_cluster import load_endpoints
+    jsonl_sink = NtnxJsonlSink(args.output)
+    watchers = [NtnxWatcher(NtnxRestApiSession(*endpoint), [jsonl_sink]) for endpoint in load_endpoints(args.clusters)]
+    for watcher in watchers:
+        watcher.rest_api.verbose = False
+    threads = [watcher.start() for watcher in watchers]
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for watcher in watchers:
+            watcher.stop()
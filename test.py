@@ -1 +1,544 @@
-# This is test
\ No newline at end of file
+# This is test
+
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from urllib.parse import parse_qs, urlparse
+import ntnx_cluster_bak2
+from ntnx_cluster_bak2 import NtnxRestApiSession, ContainersMenu, build_vm_disk_dto, build_vm_nic_spec_dto, \
+    build_vm_config_dto, decode_json, DISK_SIZE_UNIT, GET, POST
+from ntnx_preflight import NtnxIpPool, NtnxPreflightValidator
+from ntnx_jobs import NtnxJobJournal, NtnxJobRunner, NtnxReconcileJob, DONE, FAILED
+from ntnx_reconciler import NtnxPlanStep
+from ntnx_inventory_store import NtnxInventoryStore, WARM_START_KINDS
+from ntnx_entities import NtnxContainer, NtnxEntityIndex
+from ntnx_multi_cluster import NtnxClusterGroup, CLUSTER_TAG
+from ntnx_vm_clone import generate_names
+from ntnx_vm_power import NtnxVmPowerOperation
+from ntnx_vm_batch import NtnxVmBatch, parse_csv_vm_spec
+
+# Keep the menus under test from writing debug captures into the tree
+ntnx_cluster_bak2.DEBUG = False
+
+
+class FakeResponse:
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = json.dumps(body).encode("utf-8")
+
+    def close(self):
+        pass
+
+
+class FakeTransport:
+    def __init__(self, handler):
+        # Answer the requests of a session with handler(method_type, request_url, payload_json),
+        # which returns (status_code, body)
+        self.handler = handler
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def send(self, method_type, request_url, payload_json, timeout, headers=None, stream=False):
+        with self.lock:
+            self.requests.append((method_type, request_url))
+        return FakeResponse(*self.handler(method_type, request_url, payload_json))
+
+
+def make_session(handler):
+    rest_api = NtnxRestApiSession("10.0.0.1", "admin", "secret")
+    rest_api.transport = FakeTransport(handler)
+    rest_api.verbose = False
+    return rest_api
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+
+class BuildVmDtoTest(unittest.TestCase):
+    def test_nic_spec_refers_to_network_uuid(self):
+        vm_nic_spec_dto = build_vm_nic_spec_dto("net-1")
+        self.assertEqual(vm_nic_spec_dto, {"network_uuid": "net-1", "request_ip": False})
+
+    def test_nic_spec_requests_ip_address(self):
+        vm_nic_spec_dto = build_vm_nic_spec_dto("net-1", "10.0.0.5")
+        self.assertTrue(vm_nic_spec_dto["request_ip"])
+        self.assertEqual(vm_nic_spec_dto["requested_ip_address"], "10.0.0.5")
+
+    def test_ide_disk_is_empty_cdrom(self):
+        vm_disk_dto = build_vm_disk_dto("IDE")
+        self.assertTrue(vm_disk_dto["is_cdrom"] and vm_disk_dto["is_empty"])
+        self.assertNotIn("vm_disk_create", vm_disk_dto)
+
+    def test_config_leaves_out_missing_nics(self):
+        vm_config_dto = build_vm_config_dto("vm", 1, 1, 512, [build_vm_disk_dto("SCSI", "ctr-1", 100)])
+        self.assertNotIn("vm_nics", vm_config_dto)
+        self.assertEqual(vm_config_dto["vm_disks"][0]["vm_disk_create"], {"storage_container_uuid": "ctr-1",
+                                                                           "size": 100 * DISK_SIZE_UNIT})
+
+
+class PagingTest(unittest.TestCase):
+    def collection_handler(self, num_entities, grand_total=True):
+        # Serve a page/count collection of num_entities containers
+        def handler(method_type, request_url, payload_json):
+            query = parse_qs(urlparse(request_url).query)
+            page, count = int(query["page"][0]), int(query["count"][0])
+            entities = [{"name": "ctr-{}".format(index)}
+                        for index in range((page - 1) * count, min(page * count, num_entities))]
+            metadata = {"grand_total_entities": num_entities} if grand_total else {}
+            return 200, {"metadata": metadata, "entities": entities}
+        return handler
+
+    def test_paging_stops_at_grand_total(self):
+        rest_api = make_session(self.collection_handler(6))
+        entities = list(rest_api.iter_entities("storage_containers", page_size=3))
+        self.assertEqual([entity["name"] for entity in entities], ["ctr-{}".format(index) for index in range(6)])
+        self.assertEqual(len(rest_api.transport.requests), 2)
+
+    def test_paging_stops_at_short_page(self):
+        rest_api = make_session(self.collection_handler(7, grand_total=False))
+        entities = list(rest_api.iter_entities("storage_containers", page_size=3))
+        self.assertEqual(len(entities), 7)
+        self.assertEqual(len(rest_api.transport.requests), 3)
+
+    def test_error_page_raises(self):
+        rest_api = make_session(lambda method_type, request_url, payload_json: (401, {"message": "Unauthorized"}))
+        with self.assertRaisesRegex(Exception, "HTTP 401: Unauthorized"):
+            list(rest_api.iter_entities("storage_containers"))
+
+    def test_error_page_is_not_cached(self):
+        rest_api = make_session(lambda method_type, request_url, payload_json: (401, {"message": "Unauthorized"}))
+        with self.assertRaisesRegex(Exception, "HTTP 401"):
+            rest_api.get_entities("storage_containers")
+        self.assertEqual(rest_api.validated_pages.entries, {})
+        self.assertIsNone(rest_api.entity_cache.get("storage_containers"))
+
+    def test_decode_json_of_empty_body(self):
+        self.assertEqual(decode_json(b""), {})
+        self.assertEqual(decode_json(b"  \n"), {})
+
+    def test_decode_json_of_html_body(self):
+        self.assertEqual(decode_json(b"<html>Bad Gateway</html>"), {"message": "<html>Bad Gateway</html>"})
+
+
+class StreamingTest(unittest.TestCase):
+    def send_vms(self, method_type, request_url, payload_json, timeout, headers=None, stream=False):
+        # A vms page whose raw body is left to be read only when the GET was streamed
+        body = {"metadata": {"grand_total_entities": 2}, "entities": [
+            {"uuid": "vm-1", "name": "vm-1"}, {"uuid": "vm-2", "name": "vm-2"}]}
+        server_response = FakeResponse(200, body if "offset=0&" in request_url else {"entities": []})
+        server_response.raw = io.BytesIO(server_response.content if stream else b"")
+        return server_response
+
+    def get_vm_names(self, streaming):
+        rest_api = make_session(None)
+        rest_api.transport.send = self.send_vms
+        rest_api.transport.streaming = streaming
+        return [vm.name for vm in rest_api.get_entities("vms")]
+
+    def test_streaming_transport_is_streamed(self):
+        self.assertEqual(self.get_vm_names(True), ["vm-1", "vm-2"])
+
+    def test_non_streaming_transport_reads_whole_pages(self):
+        self.assertEqual(self.get_vm_names(False), ["vm-1", "vm-2"])
+
+
+class GenerateNamesTest(unittest.TestCase):
+    def test_names_are_formatted_from_start(self):
+        self.assertEqual(generate_names("vdi-{index:03d}", 2, start=9), ["vdi-009", "vdi-010"])
+
+    def test_pattern_without_index_is_rejected(self):
+        with self.assertRaises(ValueError):
+            generate_names("vdi", 2)
+
+
+class PowerWavesTest(unittest.TestCase):
+    VMS = [{"name": "vm-{}".format(index), "uuid": "vm-{}".format(index), "host_uuid": None, "power_state": "off"}
+           for index in range(3)]
+
+    def make_power_operation(self, wave_interval=0):
+        rest_api = make_session(lambda method_type, request_url, payload_json: (201, {"task_uuid": "task-1"}))
+        return NtnxVmPowerOperation(rest_api, wave_size=2, wave_interval=wave_interval)
+
+    def test_untracked_waves_need_an_interval(self):
+        power_operation = self.make_power_operation()
+        with self.assertRaises(ValueError):
+            power_operation.run(self.VMS, "ON")
+        self.assertEqual(power_operation.rest_api.transport.requests, [])
+
+    def test_vms_without_host_are_waved_cluster_wide(self):
+        power_operation = self.make_power_operation(wave_interval=0.01)
+        self.assertEqual([len(wave) for wave in power_operation.get_waves(self.VMS)], [2, 1])
+        results = power_operation.run(self.VMS, "ON")
+        self.assertEqual([result["status"] for result in results], ["SUBMITTED"] * 3)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+
+    def handler(self, method_type, request_url, payload_json):
+        self.release.wait(5)
+        return 200, {"name": "cluster", "method": method_type}
+
+    def run_threads(self, function, num_threads):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(function())) for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_identical_gets_are_coalesced(self):
+        rest_api = make_session(self.handler)
+        threads, results = self.run_threads(lambda: rest_api.rest_call(GET, "cluster", None), 8)
+        wait_until(lambda: rest_api.num_coalesced == 7)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(rest_api.transport.requests), 1)
+        self.assertEqual(results, [(200, {"name": "cluster", "method": GET})] * 8)
+        self.assertEqual(rest_api.in_flight, {})
+
+    def test_writes_are_not_coalesced(self):
+        rest_api = make_session(self.handler)
+        threads, results = self.run_threads(lambda: rest_api.rest_call(POST, "vms", "{}"), 4)
+        wait_until(lambda: len(rest_api.transport.requests) == 4)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(rest_api.num_coalesced, 0)
+        self.assertEqual(len(results), 4)
+
+    def test_get_after_a_write_is_not_coalesced(self):
+        def handler(method_type, request_url, payload_json):
+            if method_type == GET:
+                self.release.wait(5)
+            return 200, {"method": method_type}
+
+        rest_api = make_session(handler)
+        threads, results = self.run_threads(lambda: rest_api.rest_call(GET, "vms", None), 1)
+        wait_until(lambda: len(rest_api.transport.requests) == 1)
+        rest_api.rest_call(POST, "vms", "{}")
+        threads += self.run_threads(lambda: rest_api.rest_call(GET, "vms", None), 1)[0]
+        wait_until(lambda: len(rest_api.transport.requests) == 3)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(rest_api.num_coalesced, 0)
+
+    def test_later_gets_are_sent_again(self):
+        self.release.set()
+        rest_api = make_session(self.handler)
+        rest_api.rest_call(GET, "cluster", None)
+        rest_api.rest_call(GET, "cluster", None)
+        self.assertEqual(len(rest_api.transport.requests), 2)
+
+
+IP_CONFIG = {"network_address": "10.1.0.0", "prefix_length": 24, "default_gateway": "10.1.0.1",
+             "pool": [{"range": "10.1.0.10 10.1.0.12"}]}
+
+
+def cluster_handler(method_type, request_url, payload_json):
+    # A cluster of one container with 1000 MB free and one IP-managed network with 10.1.0.10 in use
+    if request_url.endswith("/addresses"):
+        return 200, {"entities": [{"ip_address": "10.1.0.10"}]}
+    elif "storage_containers?" in request_url:
+        return 200, {"metadata": {"grand_total_entities": 1}, "entities": [
+            {"storage_container_uuid": "ctr-1", "name": "ctr",
+             "usage_stats": {"storage.user_unreserved_free_bytes": str(1000 * DISK_SIZE_UNIT)}}]}
+    elif "networks?" in request_url:
+        return 200, {"metadata": {"grand_total_entities": 2}, "entities": [
+            {"uuid": "net-1", "name": "managed", "vlan_id": 1, "ip_config": IP_CONFIG},
+            {"uuid": "net-2", "name": "unmanaged", "vlan_id": 2, "ip_config": {}}]}
+    return 404, {"message": "Unknown endpoint"}
+
+
+class ClusterGroupTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def hung_handler(self, method_type, request_url, payload_json):
+        self.release.wait(5)
+        return 200, {"name": "hung"}
+
+    def make_group(self, handlers, max_workers=2, timeout=0.3):
+        group = NtnxClusterGroup([("10.0.0.{}".format(index + 1), "admin", "secret")
+                                  for index in range(len(handlers))], max_workers, timeout)
+        for rest_api, handler in zip(group.sessions, handlers):
+            rest_api.transport = FakeTransport(handler)
+            rest_api.verbose = False
+        return group
+
+    def test_hung_cluster_times_out_alone(self):
+        group = self.make_group([self.hung_handler, cluster_handler, self.hung_handler])
+        started_at = time.monotonic()
+        results, errors = group.query("cluster", "networks")
+
+        self.assertLess(time.monotonic() - started_at, 2)
+        self.assertEqual(sorted(errors), [("10.0.0.1", "cluster", "timed out"), ("10.0.0.1", "networks", "timed out"),
+                                          ("10.0.0.3", "cluster", "timed out"), ("10.0.0.3", "networks", "timed out")])
+        self.assertEqual([result[CLUSTER_TAG] for result in results["cluster"]], ["10.0.0.2"])
+        self.assertTrue(results["networks"])
+
+    def test_params_are_sent_with_their_query(self):
+        group = self.make_group([cluster_handler])
+        group.query("storage_containers", "networks", params={"networks": {"include_pool": "true"}})
+        request_urls = sorted(request_url for method_type, request_url in group.sessions[0].transport.requests)
+        self.assertEqual(len(request_urls), 2)
+        self.assertIn("include_pool=true", request_urls[0])
+        self.assertNotIn("include_pool", request_urls[1])
+
+    def test_workers_are_per_cluster(self):
+        group = self.make_group([self.hung_handler, self.hung_handler], max_workers=1)
+        group.query("cluster", "networks")
+        self.assertEqual([len(rest_api.transport.requests) for rest_api in group.sessions], [1, 1])
+
+
+class IpPoolTest(unittest.TestCase):
+    def test_allocates_free_pool_addresses_in_order(self):
+        ip_pool = NtnxIpPool(IP_CONFIG, ["10.1.0.11"])
+        self.assertEqual([ip_pool.allocate(), ip_pool.allocate(), ip_pool.allocate()],
+                         ["10.1.0.10", "10.1.0.12", None])
+
+    def test_check_detects_used_and_outside_addresses(self):
+        ip_pool = NtnxIpPool(IP_CONFIG, ["10.1.0.50"])
+        self.assertIsNone(ip_pool.check("10.1.0.51"))
+        self.assertIn("already in use", ip_pool.check("10.1.0.50"))
+        self.assertIn("already in use", ip_pool.check("10.1.0.1"))
+        self.assertIn("is not in", ip_pool.check("10.2.0.5"))
+
+    def test_reserved_address_is_not_allocated(self):
+        ip_pool = NtnxIpPool(IP_CONFIG)
+        ip_pool.reserve("10.1.0.10")
+        self.assertEqual(ip_pool.allocate(), "10.1.0.11")
+
+
+class PreflightValidatorTest(unittest.TestCase):
+    def setUp(self):
+        self.validator = NtnxPreflightValidator(make_session(cluster_handler))
+        self.validator.sync()
+
+    def test_duplicate_ip_across_specs_is_detected(self):
+        nic = {"network": "managed", "requested_ip_address": "10.1.0.20"}
+        errors = self.validator.validate([{"name": "a", "nics": [dict(nic)]}, {"name": "a", "nics": [dict(nic)]}])
+        self.assertEqual(errors[0], [])
+        self.assertEqual(len(errors), 2)
+        self.assertIn("already in use", errors[1][0])
+
+    def test_ip_in_use_on_cluster_is_detected(self):
+        errors = self.validator.validate([{"nics": [{"network": "managed", "requested_ip_address": "10.1.0.10"}]}])
+        self.assertIn("already in use", errors[0][0])
+
+    def test_allocate_ips_fills_missing_ips(self):
+        vm_specs = [{"nics": [{"network": "managed"}]}, {"nics": [{"network": "managed"}]},
+                    {"nics": [{"network": "managed"}]}]
+        errors = self.validator.validate(vm_specs, allocate_ips=True)
+        self.assertEqual([nic_spec.get("requested_ip_address") for vm_spec in vm_specs for nic_spec in vm_spec["nics"]],
+                         ["10.1.0.11", "10.1.0.12", None])
+        self.assertEqual(errors[:2], [[], []])
+        self.assertIn("No free IP address", errors[2][0])
+
+    def test_unmanaged_network_rejects_requested_ip(self):
+        errors = self.validator.validate([{"nics": [{"network": "unmanaged", "requested_ip_address": "10.1.0.5"}]}])
+        self.assertIn("does not manage IP addresses", errors[0][0])
+
+    def test_disks_share_container_free_space(self):
+        disk = {"container": "ctr", "size": 600}
+        errors = self.validator.validate([{"disks": [dict(disk)]}, {"disks": [dict(disk)]}])
+        self.assertEqual(errors[0], [])
+        self.assertIn("does not fit", errors[1][0])
+
+    def test_unknown_container_is_reported(self):
+        errors = self.validator.validate([{"disks": [{"container": "missing", "size": 1}]}])
+        self.assertEqual(errors, [["No storage_containers found with name missing"]])
+
+
+    def test_csv_disk_without_size_is_an_invalid_spec(self):
+        vm_spec = parse_csv_vm_spec({"name": "vm", "num_vcpus": "1", "memory_mb": "512", "disks": "SCSI:ctr;IDE"})
+        self.assertEqual(self.validator.validate([vm_spec]), [["Disk on ctr has no size"]])
+
+        rest_api = self.validator.rest_api
+        results = NtnxVmBatch(rest_api).run([vm_spec])
+        self.assertEqual(results, [{"name": "vm", "status": "FAILED",
+                                    "error": "Invalid spec: Disk on ctr has no size"}])
+        self.assertNotIn(POST, [method_type for method_type, request_url in rest_api.transport.requests])
+
+class FakeJob:
+    def __init__(self, items, failing=()):
+        # Items of a single phase, the failing ones raising when run
+        self.items = items
+        self.failing = set(failing)
+        self.run_items = []
+
+    def get_phases(self):
+        return [[(item, item) for item in self.items]]
+
+    def run_item(self, item):
+        self.run_items.append(item)
+        if item in self.failing:
+            raise Exception("{} failed".format(item))
+        return {"item": item}
+
+
+class JobJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.journal_dir = tempfile.TemporaryDirectory()
+        self.journal_file = os.path.join(self.journal_dir.name, "journal.jsonl")
+
+    def tearDown(self):
+        self.journal_dir.cleanup()
+
+    def run_job(self, job):
+        journal = NtnxJobJournal(self.journal_file)
+        try:
+            NtnxJobRunner(journal, 2).run(job)
+        finally:
+            journal.close()
+        return journal
+
+    def test_resume_skips_done_items_and_retries_failed_ones(self):
+        journal = self.run_job(FakeJob(["a", "b", "c"], failing=["b"]))
+        self.assertEqual({item: record["state"] for item, record in journal.records.items()},
+                         {"a": DONE, "b": FAILED, "c": DONE})
+
+        resumed_job = FakeJob(["a", "b", "c"])
+        journal = self.run_job(resumed_job)
+        self.assertEqual(resumed_job.run_items, ["b"])
+        self.assertTrue(all(record["state"] == DONE for record in journal.records.values()))
+
+    def test_run_returns_only_the_items_of_the_job(self):
+        self.run_job(FakeJob(["a", "b"]))
+        journal = NtnxJobJournal(self.journal_file)
+        try:
+            job_items = NtnxJobRunner(journal, 2).run(FakeJob(["b", "c"], failing=["c"]))
+        finally:
+            journal.close()
+        self.assertEqual(job_items, ["b", "c"])
+        self.assertEqual([journal.is_done(item) for item in job_items], [True, False])
+
+    def test_torn_last_line_is_ignored(self):
+        self.run_job(FakeJob(["a"]))
+        with open(self.journal_file, "at") as fout:
+            fout.write('{"item": "b", "sta')
+
+        resumed_job = FakeJob(["a", "b"])
+        self.run_job(resumed_job)
+        self.assertEqual(resumed_job.run_items, ["b"])
+
+    def test_reconcile_step_is_skipped_when_its_dependency_failed(self):
+        class FakeClusterState:
+            rest_api = make_session(cluster_handler)
+
+            def apply(self, step):
+                if step.name == "bad":
+                    raise Exception("Creating bad failed")
+                return "SUCCEEDED"
+
+        class FakeReconciler:
+            def plan(self):
+                return steps
+
+        cluster_state = FakeClusterState()
+        bad = NtnxPlanStep(cluster_state, "create", "storage_containers", "bad", {})
+        good = NtnxPlanStep(cluster_state, "create", "networks", "good", {})
+        steps = [bad, good, NtnxPlanStep(cluster_state, "create", "vms", "vm-1", {}, depends_on=[bad, good]),
+                 NtnxPlanStep(cluster_state, "create", "vms", "vm-2", {}, depends_on=[good])]
+        journal = self.run_job(NtnxReconcileJob(FakeReconciler()))
+
+        self.assertEqual([step.status for step in steps], [FAILED, "SUCCEEDED", "SKIPPED", "SUCCEEDED"])
+        self.assertIn("Dependency failed", journal.records[str(steps[2])]["error"])
+        self.assertTrue(all(item.startswith("10.0.0.1 ") for item in journal.records))
+
+
+class WarmStartTest(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.TemporaryDirectory()
+        self.store = NtnxInventoryStore(os.path.join(self.store_dir.name, "inventory.db"))
+        self.store.sync_cluster(make_session(cluster_handler), WARM_START_KINDS)
+
+    def tearDown(self):
+        self.store.connection.close()
+        self.store_dir.cleanup()
+
+    def test_snapshot_round_trip(self):
+        synced_at, containers = self.store.load_snapshot("10.0.0.1", "storage_containers")
+        self.assertIsNotNone(synced_at)
+        self.assertEqual([container["name"] for container in containers], ["ctr"])
+        self.assertEqual(self.store.load_snapshot("10.0.0.2", "storage_containers"), (None, []))
+
+    def test_warm_start_serves_snapshot_and_refreshes_warm_kinds_only(self):
+        rest_api = make_session(cluster_handler)
+        self.store.warm_start(rest_api).join()
+
+        containers = rest_api.entity_cache.get("storage_containers")
+        self.assertIsInstance(containers[0], NtnxContainer)
+        self.assertEqual(containers[0].storage_container_uuid, "ctr-1")
+        self.assertFalse([request_url for method_type, request_url in rest_api.transport.requests
+                          if "/vms" in request_url or request_url.endswith("/cluster")])
+
+    def test_unchanged_entities_match_their_snapshot(self):
+        rest_api = make_session(cluster_handler)
+        self.store.warm_start(rest_api).join()
+        containers_menu = ContainersMenu(rest_api)
+        rest_api.entity_cache.invalidate()
+        rest_api.entity_cache.put("storage_containers", [NtnxContainer(entity, rest_api) for entity in
+                                                         self.store.load_snapshot("10.0.0.1", "storage_containers")[1]])
+
+        self.assertEqual(len(containers_menu.sync_containers().added), 1)
+        self.assertFalse(containers_menu.sync_containers(use_cache=False))
+
+
+class EntityIndexTest(unittest.TestCase):
+    def test_sync_returns_added_updated_and_removed(self):
+        index = NtnxEntityIndex("networks")
+        change_set = index.sync([{"uuid": "1", "name": "a", "vlan_id": 1}, {"uuid": "2", "name": "b", "vlan_id": 2}])
+        self.assertEqual(len(change_set.added), 2)
+
+        change_set = index.sync([{"uuid": "1", "name": "a", "vlan_id": 1}, {"uuid": "2", "name": "b", "vlan_id": 3},
+                                 {"uuid": "3", "name": "c", "vlan_id": 4}])
+        self.assertEqual(([entity["uuid"] for entity in change_set.added],
+                          [entity["uuid"] for entity in change_set.updated], change_set.removed), (["3"], ["2"], []))
+        self.assertEqual(index.get("vlan_id", 3)["uuid"], "2")
+        self.assertEqual(index.find("vlan_id", 2), [])
+
+        change_set = index.sync([{"uuid": "3", "name": "c", "vlan_id": 4}])
+        self.assertEqual(sorted(entity["uuid"] for entity in change_set.removed), ["1", "2"])
+        self.assertRaises(KeyError, index.get, "name", "a")
+
+    def test_unchanged_sync_is_empty(self):
+        index = NtnxEntityIndex("vms")
+        vms = [{"uuid": "1", "name": "a"}]
+        index.sync(vms)
+        self.assertFalse(index.sync(vms))
+        self.assertFalse(index.sync([{"uuid": "1", "name": "a"}]))
+
+    def test_duplicate_names_are_reported(self):
+        index = NtnxEntityIndex("vms")
+        index.sync([{"uuid": "1", "name": "a"}, {"uuid": "2", "name": "a"}])
+        self.assertEqual(index.duplicates("name"), {"a": {"1", "2"}})
+        self.assertRaises(ValueError, index.get, "name", "a")
+
+    def test_model_matches_dict_of_its_fields(self):
+        index = NtnxEntityIndex("storage_containers")
+        container = {"storage_container_uuid": "ctr-1", "name": "ctr", "max_capacity": 1, "usage_stats": {}}
+        index.sync([container])
+        self.assertFalse(index.sync([NtnxContainer(container)]))
+
+
+if __name__ == "__main__":
+    unittest.main()